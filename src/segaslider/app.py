@@ -10,9 +10,10 @@ from kivy.logger import Logger
 logging.Logger.manager.root = Logger
 
 import os
+import json
 import weakref
-import math
 import asyncio
+import time
 
 # Usual kivy stuff
 from kivy.app import App
@@ -21,12 +22,17 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.effectwidget import EffectWidget, HorizontalBlurEffect
 from kivy.uix.floatlayout import FloatLayout
 from kivy.uix.gridlayout import GridLayout
+from kivy.uix.settings import SettingItem
 from kivy.clock import Clock
 import kivy.properties as kvprops
 import kivy.resources as kvres
 import kivy.metrics as kvmetrics
 
+from . import pipelines
+from . import profiler
 from . import protocol
+from . import settings
+from .helper import tracering
 
 class LEDWidget(Widget):
     led_index = kvprops.NumericProperty(0)  # @UndefinedVariable
@@ -174,35 +180,67 @@ class SegaSliderApp(App):
     def build(self):
         # Register the app directory as a resource directory
         kvres.resource_add_path(self.directory)
+        self._load_user_profiles()
+        self._settings_panel = settings.load_panel(kvres.resource_find('segaslider.settings.json'), protocol.PROFILES.names())
+        self._settings_validator = settings.SettingsValidator(self._settings_panel)
+        self._settings = settings.SliderSettings.from_config(self.config, self._settings_validator, on_error=self._on_bad_setting)
+        self._settings_widget = None
         self._slider_transport = None
         self._slider_protocol = None
+        self._tracer = tracering.TraceRing(slot_size=protocol.MAX_PACKET_LEN)
+        self._profiler = None
         self._fired = 0
-        self._led_updates = 0
+        self._led_painter = pipelines.LEDPainter(self._settings.gamma)
+        self._input_report = None
 
     def build_config(self, config):
         super().build_config(config)
-        config.setdefaults('segaslider', dict(
-            port='serial:/dev/ttyUSB0',
-            mode='diva',
-            layout='auto',
-            hwinfo='auto',
-            diffuser='auto',
-            x_overlap_mm=6.0,
-            y_overlap_mm=6.0,
-            gamma=0.5,
-            diffuser_width=16.0,
-        ))
+        config.setdefaults(settings.SECTION, settings.DEFAULTS)
 
     def build_settings(self, settings):
         super().build_settings(settings)
-        settings.add_json_panel('segaslider', self.config, kvres.resource_find('segaslider.settings.json'))
+        settings.add_json_panel('segaslider', self.config, data=json.dumps(self._settings_panel))
+        self._settings_widget = settings
 
     def get_application_config(self):
         return os.path.join(self.user_data_dir, '{}.ini'.format(self.name))
 
+    def _load_user_profiles(self):
+        path = os.path.join(self.user_data_dir, 'profiles.json')
+        if not os.path.isfile(path):
+            return
+        try:
+            loaded = protocol.PROFILES.load(path)
+        except (OSError, ValueError):
+            Logger.exception('Failed to load user profiles from %s', path)
+        else:
+            Logger.info('Loaded user profiles: %s', ', '.join(loaded))
+
+    def _refresh_setting_item(self, section, key):
+        # Show the value in the config on the settings panel again. The panel doesn't
+        # write it back since it matches the config.
+        if self._settings_widget is None:
+            return
+        for widget in self._settings_widget.walk(restrict=True):
+            if isinstance(widget, SettingItem) and widget.section == section and widget.key == key:
+                widget.value = self.config.get(section, key)
+
+    def _on_bad_setting(self, key, exc):
+        Logger.error('Invalid value for setting %s, using default: %s', key, exc)
+
     def on_config_change(self, config, section, key, value):
         super().on_config_change(config, section, key, value)
-        if section == 'segaslider':
+        if section == settings.SECTION:
+            try:
+                self._settings = self._settings.replace(self._settings_validator, key, value)
+            except ValueError as e:
+                Logger.error('Rejected invalid value for setting %s: %s', key, e)
+                # Roll back to the last known good value
+                config.set(section, key, self._settings.raw(key))
+                config.write()
+                # The panel item still shows the rejected value, refresh it once this change is done
+                Clock.schedule_once(lambda dt: self._refresh_setting_item(section, key))
+                return
             if key in ('port', 'mode', 'hwinfo',):
                 Logger.info('Serial port settings changed, restarting handler.')
                 self.reset_protocol_handler()
@@ -215,13 +253,14 @@ class SegaSliderApp(App):
             if key in ('diffuser_width', 'diffuser'):
                 Logger.info('Diffuser settings changed.')
                 self.sync_diffuser_settings()
+            if key == 'gamma':
+                self._led_painter.gamma = self._settings.gamma
+            if key in ('profiler', 'profiler_rate'):
+                self.sync_profiler()
 
     async def _reset_protocol_handler_coro(self):
-        default_mode = self.config.get('segaslider', 'mode')
-        potential_override = self.config.get('segaslider', 'hwinfo')
-        mode = default_mode if potential_override == 'auto' else potential_override
         try:
-            self._slider_transport, self._slider_protocol = await protocol.create_connection(asyncio.get_running_loop(), self.config.get('segaslider', 'port'), mode)
+            self._slider_transport, self._slider_protocol = await protocol.create_connection(asyncio.get_running_loop(), self._settings.port, self._settings.effective_hwinfo, tracer=self._tracer)
         except Exception:
             Logger.exception('Failed to connect to port')
         else:
@@ -240,32 +279,67 @@ class SegaSliderApp(App):
         # okay nodejs code
         asyncio.create_task(self._reset_protocol_handler_coro())
 
+    def panic(self):
+        self.dump_trace('panic')
+        self.reset_protocol_handler()
+
+    def dump_trace(self, reason):
+        path = os.path.join(self.user_data_dir, 'trace-{}-{}.log'.format(time.strftime('%Y%m%d-%H%M%S'), reason))
+        try:
+            with open(path, 'w') as f:
+                count = self._tracer.dump(f)
+        except OSError:
+            Logger.exception('Failed to dump protocol trace')
+        else:
+            Logger.info('Dumped %d protocol trace events to %s', count, path)
+
     def transport_available(self):
         return self._slider_transport is not None and not self._slider_transport.is_closing()
 
     def update_slider_layout(self):
         slider_widget = self.root.ids['slider_root']
-        default_mode = self.config.get('segaslider', 'mode')
-        potential_override = self.config.get('segaslider', 'layout')
-        mode = default_mode if potential_override == 'auto' else potential_override
-        slider_widget.slider_layout = mode
+        slider_widget.slider_layout = self._settings.effective_layout(protocol.PROFILES[self._settings.mode].layout)
         self.sync_electrode_overlap()
         self.sync_diffuser_settings()
 
     def sync_electrode_overlap(self):
         slider_widget = self.root.ids['slider_root']
-        slider_widget.x_overlap_mm = self.config.getfloat('segaslider', 'x_overlap_mm')
-        slider_widget.y_overlap_mm = self.config.getfloat('segaslider', 'y_overlap_mm')
+        slider_widget.x_overlap_mm = self._settings.x_overlap_mm
+        slider_widget.y_overlap_mm = self._settings.y_overlap_mm
 
     def sync_diffuser_settings(self):
         slider_widget = self.root.ids['slider_root']
-        diffuser = self.config.get('segaslider', 'diffuser')
-        if (diffuser == 'auto' and slider_widget.slider_layout == 'diva') or diffuser == 'force_on':
-            slider_widget.diffuser_width = self.config.getfloat('segaslider', 'diffuser_width')
+        if self._settings.diffuser_enabled(slider_widget.slider_layout):
+            slider_widget.diffuser_width = self._settings.diffuser_width
         else:
             slider_widget.diffuser_width = -1.0
+        # Changing diffuser width recreates the LED widgets
+        self._led_painter.invalidate()
+
+    def sync_profiler(self):
+        if self._profiler is not None and (not self._settings.profiler or self._profiler.rate != self._settings.profiler_rate):
+            self._stop_profiler()
+        if self._settings.profiler and self._profiler is None:
+            Logger.info('Profiler: Sampling at %.1fHz', self._settings.profiler_rate)
+            self._profiler = profiler.SamplingProfiler(self._settings.profiler_rate)
+            self._profiler.start()
+
+    def _stop_profiler(self):
+        self._profiler.stop()
+        prefix = os.path.join(self.user_data_dir, 'profile-{}'.format(time.strftime('%Y%m%d-%H%M%S')))
+        try:
+            paths = self._profiler.export(prefix)
+        except OSError:
+            Logger.exception('Profiler: Failed to export profile')
+        else:
+            Logger.info('Profiler: %d samples saved to %s', self._profiler.samples, ', '.join(paths))
+        shares = ', '.join('{} {:.1f}%'.format(tag, share * 100) for tag, share in self._profiler.shares().items())
+        Logger.info('Profiler: CPU shares: %s', shares or 'n/a')
+        self._profiler = None
 
     def _on_connection_lost(self, exc):
+        if exc is not None:
+            self.dump_trace('connection_lost')
         serial_status = self.root.ids['top_hud_serial_status']
         serial_status.serial_connected = False
         self.report_enabled = False
@@ -277,21 +351,10 @@ class SegaSliderApp(App):
     def _on_soft_reset(self):
         self.report_enabled = False
 
-    def _on_led(self, report):
-        self._led_updates += 1
+    def _on_led(self, brightness, led_brg):
         slider_widget = self.root.ids['slider_root']
         led_layer = slider_widget.ids['led_diffuser'].ids['leds']
-        gamma = self.config.getfloat('segaslider', 'gamma')
-        # Clamp the brightness factor to 1
-        brightness_factor = min((report['brightness'] / 63), 1.0)
-        for w in led_layer.children:
-            if len(report['led_brg']) >= (w.led_index + 1) * 3:
-                for index_rgb in range(3):
-                    # rgb -> brg
-                    # 0 -> 1, 1 -> 2, 2 -> 0
-                    led_offset = w.led_index * 3
-                    index_brg = (index_rgb + 1) % 3
-                    w.led_value[index_rgb] = math.pow((report['led_brg'][led_offset + index_brg] / 255) * brightness_factor, gamma)
+        self._led_painter.paint(brightness, led_brg, led_layer.children)
 
     def on_report_enabled(self, _inst, val):
         # Update report status indicator
@@ -307,11 +370,11 @@ class SegaSliderApp(App):
             slider_widget = self.root.ids['slider_root']
             electrode_layer = slider_widget.ids['electrodes']
             if self.report_enabled:
-                # populate the report
-                report = bytearray(slider_widget.electrodes)
-                for w in electrode_layer.children:
-                    if isinstance(w, ElectrodeWidget) and len(report) >= w.electrode_index + 1:
-                        report[w.electrode_index] = w.value
+                # populate the report (reused across ticks, the protocol copies it when framing)
+                report = self._input_report
+                if report is None or len(report) != slider_widget.electrodes:
+                    report = self._input_report = bytearray(slider_widget.electrodes)
+                pipelines.fill_input_report(report, electrode_layer.children)
                 self._slider_protocol.send_input_report(report)
 
     def on_tick(self, dt):
@@ -319,9 +382,10 @@ class SegaSliderApp(App):
         self._send_input_report()
 
     def print_fired(self, dt):
-        Logger.debug('Stats: Input %f ticks/s, LED %f updates/s', self._fired/dt, self._led_updates/dt)
+        painter = self._led_painter
+        Logger.debug('Stats: Input %f ticks/s, LED %f updates/s (%d skipped, %d partial)', self._fired/dt, painter.updates/dt, painter.skipped, painter.partial)
         self._fired = 0
-        self._led_updates = 0
+        painter.reset_stats()
 
     def on_start(self):
         self.reset_protocol_handler()
@@ -330,8 +394,11 @@ class SegaSliderApp(App):
         maxfps = Config.getint('graphics', 'maxfps')
         Clock.schedule_interval(self.on_tick, 1/maxfps if maxfps > 0 else 0)
         Clock.schedule_interval(self.print_fired, 1)
+        self.sync_profiler()
 
     def on_stop(self):
+        if self._profiler is not None:
+            self._stop_profiler()
         if self.transport_available():
             self._slider_transport.close()
         # TODO properly wait until close
@@ -13,14 +13,20 @@ class BaseJVSChecksum(object):
         return self.state
 
     def update(self, data: bytes) -> None:
-        raise NotImplemented()
+        self.state = self.compute(data, self.state)
+
+    def compute(self, data: bytes, state: T.Optional[int] = None) -> int:
+        '''
+        Checksum data in one call without touching the context state. data can
+        be any bytes-like object, including a memoryview of part of a frame.
+        Starts from init unless state is given.
+        '''
+        raise NotImplementedError()
 
 class JVSChecksum(BaseJVSChecksum):
-    def update(self, data: bytes) -> None:
-        self.state += sum(data)
-        self.state &= 0xff
+    def compute(self, data: bytes, state: T.Optional[int] = None) -> int:
+        return ((self.init if state is None else state) + sum(data)) & 0xff
 
 class NegativeJVSChecksum(BaseJVSChecksum):
-    def update(self, data: bytes) -> None:
-        self.state -= sum(data)
-        self.state &= 0xff
+    def compute(self, data: bytes, state: T.Optional[int] = None) -> int:
+        return ((self.init if state is None else state) - sum(data)) & 0xff
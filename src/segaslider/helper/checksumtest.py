@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import unittest
+from checksum import JVSChecksum, NegativeJVSChecksum
+
+class TestJVSChecksum(unittest.TestCase):
+    def test_update(self):
+        '''Incremental update'''
+        ctx = JVSChecksum()
+        ctx.update(b'\xf0\x10')
+        ctx.update(b'\x20')
+        self.assertEqual(ctx.getvalue(), 0x20)
+        ctx.reset()
+        self.assertEqual(ctx.getvalue(), 0)
+
+    def test_compute_region(self):
+        '''One-shot checksum of a memoryview region'''
+        frame = bytearray(b'\xff\x01\x02\x03\x04\xff')
+        ctx = JVSChecksum(init=0x10)
+        self.assertEqual(ctx.compute(memoryview(frame)[1:5]), 0x1a)
+        # State is untouched
+        self.assertEqual(ctx.getvalue(), 0x10)
+
+class TestNegativeJVSChecksum(unittest.TestCase):
+    def test_verify(self):
+        '''Checksum of a frame including its checksum byte is zero'''
+        ctx = NegativeJVSChecksum(init=-0xff)
+        body = b'\x10\x00'
+        value = ctx.compute(body)
+        self.assertEqual(value, 0xf1)
+        self.assertEqual(ctx.compute(body + bytes((value,))), 0)
+
+    def test_update_matches_compute(self):
+        '''Incremental and one-shot checksums agree'''
+        data = bytes(range(256))
+        ctx = NegativeJVSChecksum(init=-0xff)
+        for i in range(0, len(data), 7):
+            ctx.update(data[i:i+7])
+        self.assertEqual(ctx.getvalue(), ctx.compute(data))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,18 @@ class E0D0Context(object):
     def __init__(self, sync: int = 0xe0, esc: int = 0xd0) -> None:
         self.sync = sync
         self.esc = esc
+        self._sync_byte = bytes((sync,))
+        self._esc_byte = bytes((esc,))
+        self._sync_seq = bytes((esc, (sync-1) & 0xff))
+        self._esc_seq = bytes((esc, (esc-1) & 0xff))
+        # Escaping can be done with bytes.replace() (escape first, then sync)
+        # unless escaping the escape byte produces a sync byte. Likewise for
+        # unescaping (sync first, then escape) unless an escaped sync looks
+        # like an escape byte.
+        self._fast_escape = (esc-1) & 0xff != sync
+        self._fast_unescape = (sync-1) & 0xff != esc
         self.decoder_is_escaping = False
+        self.decoder_errors = 0
         self.encoder_is_in_transaction = False
 
     def reset(self):
@@ -22,16 +33,52 @@ class E0D0Context(object):
 
     def encode(self, data: bytes) -> bytes:
         result = bytearray()
+        self.encode_into(data, result)
+        return bytes(result)
+
+    def encode_into(self, data: T.Iterable[int], out: bytearray) -> None:
+        '''Same as encode() but appends the encoded data to out.'''
+        sync = self.sync
+        esc = self.esc
         if not self.encoder_is_in_transaction:
-            result.append(self.sync)
+            out.append(sync)
             self.encoder_is_in_transaction = True
+        if self._fast_escape:
+            if not isinstance(data, (bytes, bytearray)):
+                data = bytes(data)
+            if self._esc_byte in data or self._sync_byte in data:
+                data = data.replace(self._esc_byte, self._esc_seq).replace(self._sync_byte, self._sync_seq)
+            out += data
+            return
         for b in data:
-            if b in (self.sync, self.esc):
-                result.append(self.esc)
-                result.append((b-1) & 0xff)
+            if b == sync or b == esc:
+                out.append(esc)
+                out.append((b-1) & 0xff)
             else:
-                result.append(b)
-        return bytes(result)
+                out.append(b)
+
+    def encode_frame_buffer(self, frame: bytearray) -> bytearray:
+        '''
+        Escape a complete unescaped frame (without the sync byte) and prepend
+        the sync byte. Works in place on frame when nothing needs escaping.
+        Does not touch the encoder state.
+        '''
+        sync = self.sync
+        esc = self.esc
+        if sync in frame or esc in frame:
+            if self._fast_escape:
+                frame = frame.replace(self._esc_byte, self._esc_seq).replace(self._sync_byte, self._sync_seq)
+            else:
+                escaped = bytearray()
+                for b in frame:
+                    if b == sync or b == esc:
+                        escaped.append(esc)
+                        escaped.append((b-1) & 0xff)
+                    else:
+                        escaped.append(b)
+                frame = escaped
+        frame.insert(0, sync)
+        return frame
 
     def finalize(self, data: bytes) -> bytes:
         result = self.encode(data)
@@ -39,31 +86,63 @@ class E0D0Context(object):
         return result
 
     def decode(self, data: bytes) -> T.Tuple[bytes]:
-        result = list()
-        decoded_cur = bytearray()
+        return tuple(p for _, p in self.decode_frames(data, warn=True))
+
+    def decode_frames(self, data: bytes, warn: bool = False) -> T.Tuple[T.Tuple[bool, bytes]]:
+        '''
+        Same as decode() but also tells whether each packet is the beginning of
+        a new frame (i.e. preceded by a sync byte) or a continuation of the
+        previous one. Framing errors are counted in decoder_errors and only
+        warned about when warn is True.
+        '''
         if len(data) == 0:
             return tuple()
 
-        for b in data:
-            if b == self.sync:
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        result = list()
+        parts = data.split(self._sync_byte)
+        last = len(parts) - 1
+        for i, part in enumerate(parts):
+            if i != 0:
+                # Sync received before this part
                 if self.decoder_is_escaping:
-                    warnings.warn('Sync received after escape. Escape dropped.')
+                    self.decoder_errors += 1
+                    if warn:
+                        warnings.warn('Sync received after escape. Escape dropped.')
                 self.reset_decoder()
-                # Next packet
-                # In case of spamming sync, only one empty packet will be returned
-                if len(decoded_cur) != 0:
-                    result.append(bytes(decoded_cur))
-                    decoded_cur = bytearray()
-            elif b == self.esc:
-                if self.decoder_is_escaping:
-                    warnings.warn('Escape received after escape. Will ignore the new escape byte.')
-                else:
-                    self.decoder_is_escaping = True
-            elif self.decoder_is_escaping:
-                decoded_cur.append((b+1) & 0xff)
-                self.decoder_is_escaping = False
-            else:
-                decoded_cur.append(b)
-        result.append(bytes(decoded_cur))
+            decoded = self._unescape(part, warn)
+            # Next packet
+            # In case of spamming sync, only one empty packet will be returned
+            if len(decoded) != 0 or i == last:
+                result.append((i != 0, decoded))
         return tuple(result)
 
+    def _unescape(self, data: bytes, warn: bool) -> bytes:
+        if not self.decoder_is_escaping:
+            escapes = data.count(self._esc_byte)
+            if escapes == 0:
+                return data
+            # Fast path: every escape byte is part of an escaped sync or escape byte
+            # (these sequences can't overlap as neither ends with an escape byte)
+            if self._fast_unescape and escapes == data.count(self._sync_seq) + data.count(self._esc_seq):
+                return data.replace(self._sync_seq, self._sync_byte).replace(self._esc_seq, self._esc_byte)
+        decoded = bytearray()
+        escaping = self.decoder_is_escaping
+        for i, piece in enumerate(data.split(self._esc_byte)):
+            if i != 0:
+                # Escape received before this piece
+                if escaping:
+                    self.decoder_errors += 1
+                    if warn:
+                        warnings.warn('Escape received after escape. Will ignore the new escape byte.')
+                escaping = True
+            if len(piece) != 0:
+                if escaping:
+                    decoded.append((piece[0]+1) & 0xff)
+                    decoded += piece[1:]
+                    escaping = False
+                else:
+                    decoded += piece
+        self.decoder_is_escaping = escaping
+        return bytes(decoded)
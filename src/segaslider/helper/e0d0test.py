@@ -1,8 +1,53 @@
 #!/usr/bin/env python3
 
+import random
 import unittest
+import warnings
 from e0d0 import E0D0Context
 
+def reference_encode(data, sync=0xe0, esc=0xd0):
+    '''Byte-by-byte reference encoder'''
+    result = bytearray((sync,))
+    for b in data:
+        if b in (sync, esc):
+            result.append(esc)
+            result.append((b-1) & 0xff)
+        else:
+            result.append(b)
+    return bytes(result)
+
+def reference_decode_frames(chunks, sync=0xe0, esc=0xd0):
+    '''Byte-by-byte reference decoder'''
+    escaping = False
+    errors = 0
+    results = []
+    for data in chunks:
+        result = []
+        decoded_cur = bytearray()
+        start = False
+        if len(data) == 0:
+            results.append(())
+            continue
+        for b in data:
+            if b == sync:
+                errors += escaping
+                escaping = False
+                if len(decoded_cur) != 0:
+                    result.append((start, bytes(decoded_cur)))
+                    decoded_cur = bytearray()
+                start = True
+            elif b == esc:
+                errors += escaping
+                escaping = True
+            elif escaping:
+                decoded_cur.append((b+1) & 0xff)
+                escaping = False
+            else:
+                decoded_cur.append(b)
+        result.append((start, bytes(decoded_cur)))
+        results.append(tuple(result))
+    return results, errors
+
 class TestE0D0Context(unittest.TestCase):
     def test_decode(self):
         '''Decode (regular)'''
@@ -86,6 +131,66 @@ class TestE0D0Context(unittest.TestCase):
             actual = ctx.decode(case)
         self.assertEqual(actual, expected)
 
+    def test_decode_frames(self):
+        '''Decode with frame boundaries'''
+        case1 = b'\xe0first\xe0sec'
+        case2 = b'ond\xe0'
+        expected1 = ((True, b'first'), (True, b'sec'))
+        expected2 = ((False, b'ond'), (True, b''))
+        ctx = E0D0Context()
+        actual = ctx.decode_frames(case1)
+        self.assertEqual(actual, expected1)
+        actual = ctx.decode_frames(case2)
+        self.assertEqual(actual, expected2)
+
+    def test_decode_frames_errors(self):
+        '''Decode with frame boundaries (errors are counted, not warned)'''
+        case = b'\xe0one\xd0\xd0swo\xd0\xe0three'
+        expected = ((True, b'onetwo'), (True, b'three'))
+        ctx = E0D0Context()
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            actual = ctx.decode_frames(case)
+        self.assertEqual(actual, expected)
+        self.assertEqual(ctx.decoder_errors, 2)
+
+    def test_decode_frames_random(self):
+        '''Decode random streams the same way as the reference decoder'''
+        rng = random.Random(0xe0d0)
+        for _ in range(200):
+            data = bytes(rng.choice((0xe0, 0xd0, rng.randrange(256))) for _ in range(rng.randrange(200)))
+            cuts = sorted(rng.randrange(len(data) + 1) for _ in range(rng.randrange(5)))
+            chunks = [data[a:b] for a, b in zip([0] + cuts, cuts + [len(data)])]
+            expected, expected_errors = reference_decode_frames(chunks)
+            ctx = E0D0Context()
+            actual = [ctx.decode_frames(chunk) for chunk in chunks]
+            self.assertEqual(actual, expected)
+            self.assertEqual(ctx.decoder_errors, expected_errors)
+
+    def test_encode_random(self):
+        '''Encode random data the same way as the reference encoder'''
+        rng = random.Random(0xe0d0)
+        for sync, esc in ((0xe0, 0xd0), (0xff, 0xfd), (0xcf, 0xd0)):
+            for _ in range(50):
+                data = bytes(rng.choice((sync, esc, rng.randrange(256))) for _ in range(rng.randrange(100)))
+                with self.subTest(sync=sync, esc=esc, data=data):
+                    ctx = E0D0Context(sync=sync, esc=esc)
+                    self.assertEqual(ctx.finalize(data), reference_encode(data, sync, esc))
+                    # Escaped escape byte looks like sync when sync == esc - 1, so it doesn't round trip
+                    if (esc-1) & 0xff != sync:
+                        self.assertEqual(E0D0Context(sync=sync, esc=esc).decode(ctx.finalize(data)), (data,))
+
+    def test_encode_frame_buffer(self):
+        '''Escape a prebuilt frame buffer'''
+        ctx = E0D0Context(sync=0xff, esc=0xfd)
+        frame = bytearray(b'\x01\x02\x03')
+        self.assertIs(ctx.encode_frame_buffer(frame), frame)
+        self.assertEqual(frame, b'\xff\x01\x02\x03')
+        self.assertEqual(ctx.encode_frame_buffer(bytearray(b'\x01\xff\xfd')), b'\xff\x01\xfd\xfe\xfd\xfc')
+        self.assertFalse(ctx.encoder_is_in_transaction)
+        ctx = E0D0Context(sync=0xcf, esc=0xd0)
+        self.assertEqual(ctx.encode_frame_buffer(bytearray(b'\x01\xcf\xd0')), b'\xcf\x01\xd0\xce\xd0\xcf')
+
     def test_encode(self):
         '''Encode (regular)'''
         case = b'\x00\x01\x02\x03'
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import typing as T
+import datetime
+import time
+
+class TraceRing(object):
+    '''
+    Fixed-size in-memory ring buffer of trace events. Recording only stores
+    references, formatting is deferred until the buffer is dumped. Recorded
+    data must not be mutated afterwards, except for data recorded with
+    record_bytes(), which is copied into a preallocated slot.
+
+    Timestamps come from clock. A wall clock anchor is taken when the ring
+    is created so that dumps can be lined up with other logs.
+    '''
+    def __init__(self, capacity: int = 4096, clock: T.Callable[[], float] = time.perf_counter,
+                 slot_size: int = 256, wall_clock: T.Callable[[], float] = time.time) -> None:
+        if capacity <= 0:
+            raise ValueError('Capacity must be positive')
+        if slot_size <= 0:
+            raise ValueError('Slot size must be positive')
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.enabled = True
+        self._clock = clock
+        self._anchor = (wall_clock(), clock())
+        self._timestamps = [0.0] * capacity
+        self._events = [''] * capacity
+        self._data = [None] * capacity
+        # Length of the data copied into each slot, or -1 if the slot is unused
+        self._slot_lengths = [-1] * capacity
+        self._slots = bytearray(capacity * slot_size)
+        # Assigning to a bytearray slice makes a temporary copy of the source, go through a view
+        self._slots_view = memoryview(self._slots)
+        self._pos = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def record(self, event: str, data: T.Any = None) -> None:
+        pos = self._pos
+        self._timestamps[pos] = self._clock()
+        self._events[pos] = event
+        self._data[pos] = data
+        self._slot_lengths[pos] = -1
+        self._pos = pos + 1 if pos + 1 < self.capacity else 0
+        if self._count < self.capacity:
+            self._count += 1
+
+    def record_bytes(self, event: str, data) -> None:
+        '''
+        Record a copy of a bytes-like object without allocating. Data longer
+        than slot_size is truncated.
+        '''
+        pos = self._pos
+        self._timestamps[pos] = self._clock()
+        self._events[pos] = event
+        self._data[pos] = None
+        length = len(data)
+        if length > self.slot_size:
+            data = memoryview(data)[:self.slot_size]
+            length = self.slot_size
+        offset = pos * self.slot_size
+        self._slots_view[offset:offset+length] = data
+        self._slot_lengths[pos] = length
+        self._pos = pos + 1 if pos + 1 < self.capacity else 0
+        if self._count < self.capacity:
+            self._count += 1
+
+    def clear(self) -> None:
+        for i in range(self.capacity):
+            self._data[i] = None
+            self._slot_lengths[i] = -1
+        self._pos = 0
+        self._count = 0
+
+    def _get_data(self, i: int) -> T.Any:
+        length = self._slot_lengths[i]
+        if length < 0:
+            return self._data[i]
+        offset = i * self.slot_size
+        return bytes(self._slots[offset:offset+length])
+
+    def events(self) -> T.List[T.Tuple[float, str, T.Any]]:
+        '''Return recorded events, oldest first.'''
+        start = (self._pos - self._count) % self.capacity
+        indices = (i % self.capacity for i in range(start, start + self._count))
+        return [(self._timestamps[i], self._events[i], self._get_data(i)) for i in indices]
+
+    def wall_time(self, timestamp: float) -> float:
+        '''Convert a recorded timestamp to wall clock time (seconds since the epoch).'''
+        wall, clock = self._anchor
+        return wall + (timestamp - clock)
+
+    @staticmethod
+    def format_time(wall_time: float) -> str:
+        return datetime.datetime.fromtimestamp(wall_time).isoformat(sep=' ', timespec='microseconds')
+
+    @staticmethod
+    def format_event(timestamp: float, event: str, data: T.Any) -> str:
+        if data is None:
+            return f'{timestamp:.6f} {event}'
+        elif isinstance(data, (bytes, bytearray)):
+            return f'{timestamp:.6f} {event} {data.hex(" ")}'
+        else:
+            return f'{timestamp:.6f} {event} {data!r}'
+
+    def dump(self, fp: T.TextIO) -> int:
+        '''
+        Write all recorded events to a text file object, prefixed with their
+        local wall clock time. Returns the number of events written.
+        '''
+        events = self.events()
+        for timestamp, event, data in events:
+            fp.write(self.format_time(self.wall_time(timestamp)))
+            fp.write(' ')
+            fp.write(self.format_event(timestamp, event, data))
+            fp.write('\n')
+        return len(events)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import io
+import tracemalloc
+import unittest
+from tracering import TraceRing
+
+class TestTraceRing(unittest.TestCase):
+    def test_record(self):
+        '''Record events in order'''
+        ring = TraceRing(capacity=4, clock=lambda: 1.0)
+        ring.record('tx', b'\x01\x02')
+        ring.record('rx')
+        self.assertEqual(len(ring), 2)
+        self.assertEqual(ring.events(), [(1.0, 'tx', b'\x01\x02'), (1.0, 'rx', None)])
+
+    def test_wraparound(self):
+        '''Oldest events are overwritten'''
+        ring = TraceRing(capacity=3)
+        for i in range(5):
+            ring.record('event', i)
+        self.assertEqual(len(ring), 3)
+        self.assertEqual([data for _, _, data in ring.events()], [2, 3, 4])
+
+    def test_clear(self):
+        '''Clear empties the ring'''
+        ring = TraceRing(capacity=3)
+        ring.record('event', 1)
+        ring.clear()
+        self.assertEqual(ring.events(), [])
+
+    def test_dump(self):
+        '''Dump formats events lazily, with wall clock time'''
+        ring = TraceRing(capacity=3, clock=lambda: 0.5, wall_clock=lambda: 1000.0)
+        ring.record('tx', b'\xff\x01')
+        ring.record('lost', ValueError('oops'))
+        fp = io.StringIO()
+        self.assertEqual(ring.dump(fp), 2)
+        wall = TraceRing.format_time(1000.0)
+        self.assertEqual(fp.getvalue(), f"{wall} 0.500000 tx ff 01\n{wall} 0.500000 lost ValueError('oops')\n")
+
+    def test_wall_time(self):
+        '''Timestamps are converted using the anchor taken at creation'''
+        clock = [10.0]
+        ring = TraceRing(capacity=3, clock=lambda: clock[0], wall_clock=lambda: 1000.0)
+        clock[0] = 12.5
+        ring.record('event')
+        (timestamp, _, _), = ring.events()
+        self.assertEqual(ring.wall_time(timestamp), 1002.5)
+
+    def test_record_bytes(self):
+        '''Bytes are copied into slots and truncated to the slot size'''
+        ring = TraceRing(capacity=2, slot_size=4)
+        data = bytearray(b'\x01\x02\x03')
+        ring.record_bytes('rx', memoryview(data))
+        data[0] = 0xff
+        ring.record_bytes('tx', b'\x01\x02\x03\x04\x05')
+        ring.record_bytes('rx', b'')
+        self.assertEqual([(event, data) for _, event, data in ring.events()], [('tx', b'\x01\x02\x03\x04'), ('rx', b'')])
+        ring.record('event', 1)
+        self.assertEqual(ring.events()[-1][1:], ('event', 1))
+
+    def test_record_bytes_no_copy(self):
+        '''Recording bytes does not make a temporary copy of the data'''
+        ring = TraceRing(capacity=4, slot_size=256)
+        data = memoryview(bytearray(200))
+        for _ in range(8):
+            ring.record_bytes('rx', data)
+        tracemalloc.start()
+        try:
+            before, _peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            ring.record_bytes('rx', data)
+            _current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak - before, len(data))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+'''
+Load generator for multi-slider setups.
+
+Accepts slider connections on a local TCP port, drives each of them with a
+SliderHost (hardware info, reset, enable reports, then LED reports at the LED
+rate) and spawns emulated devices that connect to it and stream input
+reports at the tick rate. Use --devices 0 to only drive external devices
+(e.g. the slider app configured with tcp://127.0.0.1:<port>).
+
+Usage: python -m segaslider.loadgen [--devices N] [--duration SECONDS] [--port PORT] [--profile PREFIX]
+'''
+
+import typing as T
+
+import argparse
+import asyncio
+import sys
+import time
+
+from . import protocol
+from .protocolbench import add_profile_arguments, profiled
+
+
+class EmulatedDevice(object):
+    '''SliderDevice that streams input reports while reports are enabled.'''
+    def __init__(self, mode: str = 'diva') -> None:
+        self.device = protocol.SliderDevice(mode)
+        self.enabled = False
+        self.leds = 0
+        self.ticks = 0
+        self._input_report = bytearray(32)
+        self.device.on('report_state_change', self._on_report_state_change)
+        self.device.on('led', self._on_led)
+
+    def _on_report_state_change(self, enabled):
+        self.enabled = enabled
+
+    def _on_led(self, brightness, led_brg):
+        self.leds += 1
+
+    def tick(self) -> None:
+        if not self.enabled:
+            return
+        ticks = self.ticks
+        self._input_report[ticks & 0x1f] = 0xfe if ticks & 0x20 else 0x00
+        self.device.send_input_report(self._input_report)
+        self.ticks = ticks + 1
+
+
+class HostStats(object):
+    def __init__(self) -> None:
+        self.hosts = 0
+        self.failed = 0
+        self.reports = 0
+        self.reports_dropped = 0
+        self.leds = 0
+        self.exceptions = 0
+        self.request_latencies = []
+        self.longest_report_gap = 0.0
+
+
+async def drive_host(host: protocol.SliderHost, stats: HostStats, led_rate: float, stop: asyncio.Event) -> None:
+    '''Bring up a connected slider and keep it busy until stop is set.'''
+    loop = asyncio.get_running_loop()
+    try:
+        for request in (host.get_hw_info, host.reset):
+            start = time.monotonic()
+            await request()
+            stats.request_latencies.append(time.monotonic() - start)
+        await host.enable_reports()
+    except (ConnectionError, asyncio.TimeoutError, ValueError):
+        stats.failed += 1
+        return
+
+    async def consume():
+        last = None
+        async for report in host.reports():
+            stats.reports += 1
+            if last is not None:
+                stats.longest_report_gap = max(stats.longest_report_gap, report.timestamp - last)
+            last = report.timestamp
+
+    consumer = loop.create_task(consume())
+    stats.hosts += 1
+    led_brg = bytearray(96)
+    try:
+        while not stop.is_set():
+            led_brg[stats.leds % 96] ^= 0xff
+            await host.send_led(63, bytes(led_brg))
+            stats.leds += 1
+            await asyncio.sleep(1 / led_rate)
+    except ConnectionError:
+        stats.failed += 1
+    finally:
+        consumer.cancel()
+        stats.reports_dropped += host.reports_dropped
+        stats.exceptions += host.exceptions
+
+
+async def run_devices(devices: T.Sequence[EmulatedDevice], tick_rate: float, stop: asyncio.Event) -> None:
+    # One ticker for all devices scales much better than a task per device
+    interval = 1 / tick_rate
+    next_tick = time.monotonic()
+    while not stop.is_set():
+        for device in devices:
+            device.tick()
+        next_tick += interval
+        await asyncio.sleep(max(next_tick - time.monotonic(), 0))
+
+
+async def loadgen(devices: int, duration: float, tick_rate: float, led_rate: float,
+                  port: int = 0, mode: str = 'diva', timeout: float = 1.0) -> T.Dict[str, float]:
+    loop = asyncio.get_running_loop()
+    stats = HostStats()
+    drivers = []
+    stop = asyncio.Event()
+
+    def host_factory():
+        host = protocol.SliderHost(timeout=timeout)
+        host.on('connection_made', lambda: drivers.append(loop.create_task(drive_host(host, stats, led_rate, stop))))
+        return host
+
+    server = await loop.create_server(host_factory, '127.0.0.1', port)
+    port = server.sockets[0].getsockname()[1]
+    emulated = []
+    transports = []
+    try:
+        connect_start = time.monotonic()
+        for _ in range(devices):
+            device = EmulatedDevice(mode)
+            transport, _protocol = await loop.create_connection(lambda: device.device, '127.0.0.1', port)
+            emulated.append(device)
+            transports.append(transport)
+        connect_time = time.monotonic() - connect_start
+        # Run time starts once all emulated devices are connected
+        start = time.monotonic()
+        loop.call_later(duration, stop.set)
+        await run_devices(emulated, tick_rate, stop)
+        await asyncio.gather(*drivers)
+        elapsed = time.monotonic() - start
+    finally:
+        for transport in transports:
+            transport.close()
+        server.close()
+        await server.wait_closed()
+
+    latencies = sorted(stats.request_latencies)
+    return dict(
+        devices=devices,
+        hosts=stats.hosts,
+        failed=stats.failed,
+        connect_time=connect_time,
+        elapsed=elapsed,
+        input_reports=stats.reports,
+        input_reports_per_s=stats.reports / elapsed if elapsed > 0 else 0.0,
+        input_reports_dropped=stats.reports_dropped,
+        led_reports=stats.leds,
+        led_reports_delivered=sum(device.leds for device in emulated),
+        exceptions=stats.exceptions,
+        request_latency_median_ms=latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        request_latency_max_ms=latencies[-1] * 1000 if latencies else 0.0,
+        longest_report_gap_ms=stats.longest_report_gap * 1000,
+    )
+
+
+def main(argv: T.Optional[T.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Slider host/device load generator.')
+    parser.add_argument('--devices', type=int, default=100, help='Emulated devices to spawn (default: 100)')
+    parser.add_argument('--duration', type=float, default=10.0, help='Run time in seconds (default: 10)')
+    parser.add_argument('--tick-rate', type=float, default=100.0, help='Input reports per device per second (default: 100)')
+    parser.add_argument('--led-rate', type=float, default=60.0, help='LED reports per host per second (default: 60)')
+    parser.add_argument('--port', type=int, default=0, help='TCP port to listen on (default: any free port)')
+    parser.add_argument('--mode', default='diva', choices=protocol.PROFILES.names(), help='Emulated device profile (default: diva)')
+    parser.add_argument('--timeout', type=float, default=1.0, help='Request timeout in seconds (default: 1.0)')
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with profiled(args):
+        result = asyncio.run(loadgen(args.devices, args.duration, args.tick_rate, args.led_rate, args.port, args.mode, args.timeout))
+    for key, value in result.items():
+        print(f'{key}: {value:.3f}' if isinstance(value, float) else f'{key}: {value}')
+    return 0 if result['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
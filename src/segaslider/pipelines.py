@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+'''
+Kivy-free parts of the LED and touch pipelines, shared by the app and the
+soak benchmark. Widgets are duck typed: LED widgets have led_index and
+led_value, electrode widgets have electrode_index and value.
+'''
+
+import typing as T
+
+import math
+
+
+class LEDPainter(object):
+    '''
+    Applies LED reports to LED widgets. Identical reports are skipped and
+    only segments that changed since the last report are repainted. The last
+    report is kept in a reused buffer and gamma correction uses a lookup
+    table, so painting does not allocate besides the new widget values.
+    '''
+    def __init__(self, gamma: float) -> None:
+        self._gamma = gamma
+        self._last_brg = bytearray()
+        self._last_view = memoryview(self._last_brg)
+        self._last_brightness = None
+        self._lut = None
+        self._lut_brightness = None
+        self.updates = 0
+        self.skipped = 0
+        self.partial = 0
+
+    @property
+    def gamma(self) -> float:
+        return self._gamma
+
+    @gamma.setter
+    def gamma(self, value: float) -> None:
+        self._gamma = value
+        self._lut = None
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        '''Force the next report to repaint every segment (e.g. after the widgets were recreated).'''
+        self._last_brightness = None
+
+    def reset_stats(self) -> None:
+        self.updates = 0
+        self.skipped = 0
+        self.partial = 0
+
+    def _get_lut(self, brightness: int) -> T.List[float]:
+        if self._lut is None or self._lut_brightness != brightness:
+            # Clamp the brightness factor to 1
+            brightness_factor = min((brightness / 63), 1.0)
+            self._lut = [math.pow((c / 255) * brightness_factor, self._gamma) for c in range(256)]
+            self._lut_brightness = brightness
+        return self._lut
+
+    def paint(self, brightness: int, led_brg, widgets: T.Iterable[T.Any]) -> None:
+        '''
+        Paint a report onto widgets. led_brg can be a view into the receive
+        buffer, it is not kept after returning.
+        '''
+        self.updates += 1
+        last_brg = self._last_brg
+        # Only diff against the last report if everything else that affects the output stays the same
+        partial = self._last_brightness is not None and brightness == self._last_brightness and len(led_brg) == len(last_brg)
+        if partial and led_brg == last_brg:
+            self.skipped += 1
+            return
+
+        lut = self._get_lut(brightness)
+        length = len(led_brg)
+        for w in widgets:
+            led_offset = w.led_index * 3
+            if length >= led_offset + 3:
+                # brg -> rgb
+                b = led_brg[led_offset]
+                r = led_brg[led_offset+1]
+                g = led_brg[led_offset+2]
+                if partial and b == last_brg[led_offset] and r == last_brg[led_offset+1] and g == last_brg[led_offset+2]:
+                    continue
+                w.led_value = [lut[r], lut[g], lut[b]]
+        if len(last_brg) == length:
+            # Copy through the view, assigning to a bytearray slice makes a temporary copy
+            self._last_view[:] = led_brg
+        else:
+            self._last_brg = bytearray(led_brg)
+            self._last_view = memoryview(self._last_brg)
+        self._last_brightness = brightness
+        if partial:
+            self.partial += 1
+
+
+def fill_input_report(report: bytearray, electrodes: T.Iterable[T.Any]) -> None:
+    '''Fill an input report in place from electrode widgets.'''
+    length = len(report)
+    for w in electrodes:
+        index = getattr(w, 'electrode_index', None)
+        if index is not None and length >= index + 1:
+            report[index] = w.value
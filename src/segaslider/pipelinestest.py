@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import unittest
+from pipelines import LEDPainter, fill_input_report
+
+class FakeLED(object):
+    def __init__(self, led_index):
+        self.led_index = led_index
+        self.led_value = None
+        self.paints = 0
+
+    def __setattr__(self, key, value):
+        if key == 'led_value' and value is not None:
+            self.paints += 1
+        super().__setattr__(key, value)
+
+class FakeElectrode(object):
+    def __init__(self, electrode_index, value):
+        self.electrode_index = electrode_index
+        self.value = value
+
+class TestLEDPainter(unittest.TestCase):
+    def setUp(self):
+        self.leds = [FakeLED(i) for i in range(4)]
+        self.painter = LEDPainter(gamma=1.0)
+
+    def test_paint(self):
+        '''brg is painted as rgb with brightness applied'''
+        self.painter.paint(63, bytes((0, 255, 0)) + bytes(9), self.leds)
+        self.assertEqual(self.leds[0].led_value, [1.0, 0.0, 0.0])
+        self.painter.paint(0, bytes((0, 255, 0)) + bytes(9), self.leds)
+        self.assertEqual(self.leds[0].led_value, [0.0, 0.0, 0.0])
+
+    def test_skip_identical(self):
+        '''Identical reports are skipped'''
+        self.painter.paint(63, bytes(12), self.leds)
+        self.painter.paint(63, bytes(12), self.leds)
+        self.assertEqual([w.paints for w in self.leds], [1, 1, 1, 1])
+        self.assertEqual((self.painter.updates, self.painter.skipped), (2, 1))
+
+    def test_partial(self):
+        '''Only changed segments are repainted'''
+        self.painter.paint(63, bytes(12), self.leds)
+        self.painter.paint(63, bytes(6) + b'\x01' + bytes(5), self.leds)
+        self.assertEqual([w.paints for w in self.leds], [1, 1, 2, 1])
+        self.assertEqual(self.painter.partial, 1)
+
+    def test_view_not_kept(self):
+        '''Reports can be views into a buffer that is reused'''
+        buf = bytearray(12)
+        view = memoryview(buf)
+        self.painter.paint(63, view, self.leds)
+        buf[0] = 0xff
+        self.painter.paint(63, view, self.leds)
+        self.assertEqual(self.leds[0].led_value, [0.0, 0.0, 1.0])
+
+    def test_invalidate(self):
+        '''Gamma change and invalidation repaint everything'''
+        self.painter.paint(63, bytes(12), self.leds)
+        self.painter.gamma = 0.5
+        self.painter.paint(63, bytes(12), self.leds)
+        self.painter.invalidate()
+        self.painter.paint(63, bytes(12), self.leds)
+        self.assertEqual([w.paints for w in self.leds], [3, 3, 3, 3])
+
+    def test_short_report(self):
+        '''LEDs without data in the report are left alone'''
+        self.painter.paint(63, bytes(7), self.leds)
+        self.assertEqual([w.paints for w in self.leds], [1, 1, 0, 0])
+
+class TestFillInputReport(unittest.TestCase):
+    def test_fill(self):
+        '''Electrode values are written at their index'''
+        report = bytearray(3)
+        fill_input_report(report, [FakeElectrode(2, 0xfe), FakeElectrode(0, 0x10), FakeElectrode(5, 0x20), object()])
+        self.assertEqual(report, b'\x10\x00\xfe')
+
+if __name__ == '__main__':
+    unittest.main()
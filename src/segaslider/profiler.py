@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import typing as T
+
+import collections
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+
+# A sample is tagged with the first rule (in order) that matches any frame on the stack.
+# filename is matched as a substring of the frame's file path (with forward slashes),
+# function is matched exactly unless it is None.
+TagRule = namedtuple('TagRule', ('tag', 'filename', 'function'))
+
+DEFAULT_TAG_RULES = (
+    TagRule('led', 'segaslider/app.py', '_on_led'),
+    TagRule('touch', 'segaslider/app.py', '_send_input_report'),
+    TagRule('touch', 'segaslider/app.py', 'on_touch_down'),
+    TagRule('touch', 'segaslider/app.py', 'on_touch_up'),
+    TagRule('touch', 'segaslider/app.py', 'on_touch_move'),
+    TagRule('protocol', 'segaslider/protocol.py', None),
+    TagRule('protocol', 'segaslider/helper/', None),
+    TagRule('idle', 'selectors.py', None),
+    # ProactorEventLoop, the default on Windows, waits in IocpProactor._poll
+    TagRule('idle', 'asyncio/windows_events.py', '_poll'),
+    TagRule('kivy_frame', 'kivy/', None),
+)
+
+DEFAULT_TAG = 'other'
+IDLE_TAG = 'idle'
+
+Frame = T.Tuple[str, str]
+
+
+class SamplingProfiler(object):
+    '''
+    Low overhead statistical profiler. A background thread periodically
+    samples the stack of the target thread, so the profiled code does not pay
+    any per-call tracing cost.
+    '''
+    def __init__(self, rate: float = 100.0, rules: T.Sequence[TagRule] = DEFAULT_TAG_RULES) -> None:
+        if rate <= 0:
+            raise ValueError('Sampling rate must be positive')
+        self.rate = rate
+        self.rules = tuple(TagRule(r.tag, r.filename.replace('\\', '/'), r.function) for r in rules)
+        self._stacks = collections.Counter()
+        self._thread = None
+        self._target_ident = None
+        self._stop = threading.Event()
+        self.started_at = None
+        self.elapsed = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    @property
+    def samples(self) -> int:
+        return sum(self._stacks.values())
+
+    def start(self, thread_ident: T.Optional[int] = None) -> None:
+        '''Start sampling the given thread (the calling thread by default).'''
+        if self.running:
+            return
+        self._target_ident = thread_ident if thread_ident is not None else threading.get_ident()
+        self._stop.clear()
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='SamplingProfiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.elapsed += time.perf_counter() - self.started_at
+
+    def clear(self) -> None:
+        self._stacks.clear()
+        self.elapsed = 0.0
+
+    def _run(self) -> None:
+        interval = 1.0 / self.rate
+        while not self._stop.wait(interval):
+            frame = sys._current_frames().get(self._target_ident)
+            if frame is None:
+                # Target thread is gone
+                break
+            self.sample(frame)
+            del frame
+
+    def sample(self, frame) -> None:
+        '''Record the stack that ends at frame.'''
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        self._stacks[tuple(stack)] += 1
+
+    def tag(self, stack: T.Sequence[Frame]) -> str:
+        normalized = tuple((filename.replace('\\', '/'), function) for filename, function in stack)
+        for rule in self.rules:
+            for filename, function in normalized:
+                if rule.filename in filename and (rule.function is None or rule.function == function):
+                    return rule.tag
+        return DEFAULT_TAG
+
+    def shares(self, include_idle: bool = False) -> T.Dict[str, float]:
+        '''Fraction of samples per tag. Idle samples are excluded unless include_idle is True.'''
+        counts = collections.Counter()
+        for stack, count in self._stacks.items():
+            tag = self.tag(stack)
+            if include_idle or tag != IDLE_TAG:
+                counts[tag] += count
+        total = sum(counts.values())
+        if total == 0:
+            return {}
+        return {tag: count / total for tag, count in counts.most_common()}
+
+    def collapsed(self) -> T.List[str]:
+        '''
+        Samples in collapsed stack format (as consumed by flamegraph.pl and
+        compatible tools), with the tag as the root frame.
+        '''
+        lines = []
+        for stack, count in self._stacks.most_common():
+            frames = ';'.join(f'{os.path.basename(filename)}:{function}' for filename, function in stack)
+            lines.append(f'{self.tag(stack)};{frames} {count}')
+        return lines
+
+    def export(self, prefix: str) -> T.Tuple[str, str]:
+        '''
+        Write <prefix>.collapsed and a <prefix>.txt summary with per-tag
+        shares. Returns the paths written.
+        '''
+        collapsed_path = f'{prefix}.collapsed'
+        summary_path = f'{prefix}.txt'
+        with open(collapsed_path, 'w') as f:
+            for line in self.collapsed():
+                f.write(line)
+                f.write('\n')
+        with open(summary_path, 'w') as f:
+            f.write(f'samples: {self.samples}\n')
+            f.write(f'duration: {self.elapsed:.3f}s\n')
+            f.write(f'rate: {self.rate:.1f}Hz\n')
+            for tag, share in self.shares(include_idle=True).items():
+                f.write(f'{tag}: {share * 100:.1f}% (wall)\n')
+            for tag, share in self.shares().items():
+                f.write(f'{tag}: {share * 100:.1f}% (busy)\n')
+        return collapsed_path, summary_path
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+from profiler import SamplingProfiler, TagRule, IDLE_TAG
+
+RULES = (
+    TagRule('render', 'profilertest.py', 'render'),
+    TagRule('io', 'profilertest.py', 'io'),
+)
+
+def render(profiler):
+    profiler.sample(sys._getframe())
+
+def io(profiler):
+    profiler.sample(sys._getframe())
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+class TestSamplingProfiler(unittest.TestCase):
+    def test_tag_shares(self):
+        '''Samples are tagged and counted per subsystem'''
+        profiler = SamplingProfiler(rules=RULES)
+        for _ in range(3):
+            render(profiler)
+        io(profiler)
+        profiler.sample(sys._getframe())
+        self.assertEqual(profiler.samples, 5)
+        self.assertEqual(profiler.shares(), dict(render=0.6, io=0.2, other=0.2))
+
+    def test_tag_idle(self):
+        '''Event loops waiting for events are tagged as idle'''
+        profiler = SamplingProfiler()
+        loop = (('C:\\Python39\\lib\\asyncio\\base_events.py', 'run_forever'), ('C:\\Python39\\lib\\asyncio\\base_events.py', '_run_once'))
+        proactor = loop + (('C:\\Python39\\lib\\asyncio\\windows_events.py', 'select'), ('C:\\Python39\\lib\\asyncio\\windows_events.py', '_poll'))
+        selector = loop + (('/usr/lib/python3.9/selectors.py', 'select'),)
+        self.assertEqual(profiler.tag(proactor), IDLE_TAG)
+        self.assertEqual(profiler.tag(selector), IDLE_TAG)
+        # Handling a completed read is not idle time
+        reading = loop + (('C:\\Python39\\lib\\asyncio\\windows_events.py', 'finish_recv'),)
+        self.assertNotEqual(profiler.tag(reading), IDLE_TAG)
+
+    def test_collapsed(self):
+        '''Collapsed stacks are rooted at the tag'''
+        profiler = SamplingProfiler(rules=RULES)
+        render(profiler)
+        render(profiler)
+        line, = profiler.collapsed()
+        self.assertTrue(line.startswith('render;'))
+        self.assertTrue(line.endswith(';profilertest.py:test_collapsed;profilertest.py:render 2'))
+
+    def test_live(self):
+        '''Sample the calling thread in the background'''
+        profiler = SamplingProfiler(rate=200.0, rules=(TagRule('busy', 'profilertest.py', 'busy'),))
+        profiler.start()
+        try:
+            busy(0.3)
+        finally:
+            profiler.stop()
+        self.assertGreater(profiler.samples, 0)
+        self.assertIn('busy', profiler.shares())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            collapsed_path, summary_path = profiler.export(os.path.join(tmpdir, 'profile'))
+            with open(collapsed_path, 'r') as f:
+                self.assertIn('profilertest.py:busy', f.read())
+            with open(summary_path, 'r') as f:
+                self.assertIn('busy:', f.read())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,47 +3,27 @@
 import typing as T
 
 import asyncio
-import io
 import serial_asyncio
-import bluetooth
+import collections
 import enum
 import ipaddress
 import itertools
+import json
 import logging
 import re
 import struct
+import time
 import urllib.parse
 from collections import namedtuple
 
 from .helper import e0d0
 from .helper import checksum
+from .helper import tracering
 
 SliderHardwareInfo = namedtuple('SliderHardwareInfo',
                                 ('model', 'device_class', 'chip_pn', 'unk_0xe', 'fw_ver', 'unk_0x10', 'unk_0x11',))
 _hwinfo_packer = struct.Struct('<8sB5s4B')
 
-HW_INFO = dict(
-    diva=_hwinfo_packer.pack(*SliderHardwareInfo(
-        model=b'15275   ',
-        device_class=0xa0,
-        chip_pn=b'06687',
-        unk_0xe=0xff,
-        fw_ver=0x90,
-        unk_0x10=0x00,
-        unk_0x11=0x64
-    )),
-    chu=_hwinfo_packer.pack(*SliderHardwareInfo(
-        model=b'15330   ',
-        device_class=0xa0,
-        chip_pn=b'06712',
-        unk_0xe=0xff,
-        fw_ver=0x90,
-        unk_0x10=0x00,
-        unk_0x11=0x64
-    )),
-)
-
-
 RFCOMM_URLSAFE_BDADDR = re.compile(r'^[A-Fa-f0-9]{2}-[A-Fa-f0-9]{2}-[A-Fa-f0-9]{2}-[A-Fa-f0-9]{2}-[A-Fa-f0-9]{2}-[A-Fa-f0-9]{2}$')
 
 
@@ -85,40 +65,169 @@ class SliderCommand(enum.IntEnum):
     get_hw_info = 0xf0
 
 
+# Commands with fixed handlers on every profile, which can't be redefined as empty responses
+RESERVED_COMMANDS = frozenset((
+    SliderCommand.input_report,
+    SliderCommand.led_report,
+    SliderCommand.enable_slider_report,
+    SliderCommand.disable_slider_report,
+    SliderCommand.reset,
+    SliderCommand.exception,
+    SliderCommand.get_hw_info,
+))
+
+
+# Largest possible packet: cmd, argc, 255 bytes of args and checksum
+MAX_PACKET_LEN = 0xff + 3
+
+
 class ExceptionCode1(enum.IntEnum):
     wrong_checksum = 0x1
     bus_error = 0x2
     internal_error = 0xed
 
 
-class SliderDevice(asyncio.Protocol):
-    def __init__(self, mode='diva'):
-        if mode not in HW_INFO:
-            raise ValueError(f'Unsupported mode {mode}')
+def _encode_frame(e0d0ctx: e0d0.E0D0Context, cksumctx: checksum.BaseJVSChecksum, cmd: int, args: T.Optional[bytes] = None) -> bytearray:
+    # Lay out the whole unescaped frame first so that checksumming and escaping are done in bulk
+    frame = bytearray((cmd, len(args) if args is not None else 0))
+    if args is not None:
+        frame += args
+    frame.append(cksumctx.compute(frame))
+    return e0d0ctx.encode_frame_buffer(frame)
+
+
+def encode_frame(cmd: int, args: T.Optional[bytes] = None) -> bytes:
+    '''Build a complete framed, escaped and checksummed packet.'''
+    return bytes(_encode_frame(e0d0.E0D0Context(sync=0xff, esc=0xfd), checksum.NegativeJVSChecksum(init=-0xff), cmd, args))
+
+
+SliderProfile = namedtuple('SliderProfile', ('name', 'hw_info', 'layout', 'empty_response_commands', 'responses'))
+
+
+class ProfileRegistry(object):
+    '''
+    Registry of emulated slider models. Replies that never change are encoded
+    once when a profile is registered.
+    '''
+    LAYOUTS = ('diva', 'chu')
+
+    def __init__(self) -> None:
+        self._profiles = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._profiles
+
+    def __getitem__(self, name: str) -> SliderProfile:
+        return self._profiles[name]
+
+    def names(self) -> T.Tuple[str]:
+        return tuple(self._profiles.keys())
+
+    def register(self, name: str, hw_info: SliderHardwareInfo, layout: str, empty_response_commands: T.Iterable[int] = ()) -> SliderProfile:
+        profile = self._make_profile(name, hw_info, layout, empty_response_commands)
+        self._profiles[name] = profile
+        return profile
+
+    def _make_profile(self, name: str, hw_info: SliderHardwareInfo, layout: str, empty_response_commands: T.Iterable[int]) -> SliderProfile:
+        if layout not in self.LAYOUTS:
+            raise ValueError(f'Unsupported layout {layout} for profile {name}')
+        if len(hw_info.model) != 8 or len(hw_info.chip_pn) != 5:
+            raise ValueError(f'Model must be 8 bytes and chip part number must be 5 bytes long for profile {name}')
+        for field in ('device_class', 'unk_0xe', 'fw_ver', 'unk_0x10', 'unk_0x11'):
+            value = getattr(hw_info, field)
+            if not isinstance(value, int) or not 0 <= value <= 0xff:
+                raise ValueError(f'Hardware info field {field} must be a byte (0-255) for profile {name}, got {value!r}')
+        empty_response_commands = tuple(empty_response_commands)
+        for cmd in empty_response_commands:
+            if not 0 <= cmd <= 0xff:
+                raise ValueError(f'Invalid command 0x{cmd:x} for profile {name}')
+            if cmd in RESERVED_COMMANDS:
+                raise ValueError(f'Command 0x{cmd:02x} is reserved and cannot be an empty response for profile {name}')
+        responses = {
+            SliderCommand.get_hw_info: encode_frame(SliderCommand.get_hw_info, _hwinfo_packer.pack(*hw_info)),
+            SliderCommand.reset: encode_frame(SliderCommand.reset),
+            SliderCommand.disable_slider_report: encode_frame(SliderCommand.disable_slider_report),
+        }
+        for cmd in empty_response_commands:
+            responses[cmd] = encode_frame(cmd)
+        return SliderProfile(name, hw_info, layout, empty_response_commands, responses)
+
+    def load(self, path: str) -> T.Tuple[str]:
+        '''
+        Load extra profiles from a JSON file. The file contains an object that
+        maps profile names to objects with the keys "layout", "hw_info" (fields
+        of SliderHardwareInfo, with model and chip_pn as strings) and optionally
+        "empty_response_commands". Profiles that are already registered
+        cannot be redefined. Either all profiles in the file are registered or,
+        if any of them is invalid, none are.
+        '''
+        with open(path, 'r') as f:
+            definitions = json.load(f)
+        if not isinstance(definitions, dict):
+            raise ValueError('Profiles file must contain an object')
+        existing = [name for name in definitions if name in self]
+        if existing:
+            raise ValueError(f'Profiles already registered: {", ".join(existing)}')
+        # Validate everything before registering anything
+        profiles = []
+        for name, definition in definitions.items():
+            try:
+                hw_info = dict(definition['hw_info'])
+                hw_info['model'] = hw_info['model'].encode('ascii')
+                hw_info['chip_pn'] = hw_info['chip_pn'].encode('ascii')
+                profiles.append(self._make_profile(name, SliderHardwareInfo(**hw_info), definition['layout'], definition.get('empty_response_commands', ())))
+            except (KeyError, TypeError, AttributeError, UnicodeEncodeError, struct.error) as e:
+                raise ValueError(f'Malformed definition for profile {name}: {e!r}') from e
+        for profile in profiles:
+            self._profiles[profile.name] = profile
+        return tuple(profile.name for profile in profiles)
+
+
+PROFILES = ProfileRegistry()
+PROFILES.register('diva', SliderHardwareInfo(
+    model=b'15275   ',
+    device_class=0xa0,
+    chip_pn=b'06687',
+    unk_0xe=0xff,
+    fw_ver=0x90,
+    unk_0x10=0x00,
+    unk_0x11=0x64
+), layout='diva', empty_response_commands=(SliderCommand.unk_0x09, SliderCommand.unk_0x0a))
+PROFILES.register('chu', SliderHardwareInfo(
+    model=b'15330   ',
+    device_class=0xa0,
+    chip_pn=b'06712',
+    unk_0xe=0xff,
+    fw_ver=0x90,
+    unk_0x10=0x00,
+    unk_0x11=0x64
+), layout='chu')
+
+
+class _SliderProtocolBase(asyncio.Protocol):
+    '''
+    Framing shared by both ends of the link. Incoming packets are unframed,
+    stitched, checksummed and dispatched through self._dispatch.
+    '''
+    def __init__(self, logger_name: str, tracer: T.Optional[tracering.TraceRing] = None):
         self._transport = None
-        self._logger = logging.getLogger('SliderDevice')
+        self._logger = logging.getLogger(logger_name)
         self._logger.debug('Protocol handler created')
-        self._mode = mode
+        self._tracer = tracer
         self._e0d0ctx = e0d0.E0D0Context(sync=0xff, esc=0xfd)
         self._cksumctx_rx = checksum.NegativeJVSChecksum(init=-0xff)
         self._cksumctx_tx = checksum.NegativeJVSChecksum(init=-0xff)
-        self._partial_packets = io.BytesIO()
+        # Packets are stitched in place to avoid allocating per packet
+        self._rx_buf = bytearray(MAX_PACKET_LEN)
+        self._rx_view = memoryview(self._rx_buf)
+        self._rx_len = 0
+        # Every packet starts after a sync byte, so anything received outside
+        # of a packet is ignored until the next sync
+        self._discarding = True
+        self._discarded = False
+        self.rx_dropped = 0
         self._callback = {}
-        # Common commands
-        self._dispatch = {
-            SliderCommand.input_report: self._handle_input_report_one_shot,
-            SliderCommand.led_report: self._handle_led_report,
-            SliderCommand.enable_slider_report: self._handle_enable_slider_report,
-            SliderCommand.disable_slider_report: self._handle_disable_slider_report,
-            SliderCommand.reset: self._handle_reset,
-            SliderCommand.get_hw_info: self._handle_get_hw_info,
-        }
-        # Mode-specific commands
-        if self._mode == 'diva':
-            self._dispatch.update({
-                SliderCommand.unk_0x09: self._handle_empty_response,
-                SliderCommand.unk_0x0a: self._handle_empty_response,
-            })
+        self._dispatch = {}
 
     def on(self, event, cb):
         self._callback[event] = cb
@@ -127,31 +236,161 @@ class SliderDevice(asyncio.Protocol):
         if event in self._callback:
             return self._callback[event](*argc, **argv)
 
+    def _trace(self, event, data=None):
+        if self._tracer is not None and self._tracer.enabled:
+            self._tracer.record(event, data)
+
+    def _trace_bytes(self, event, data):
+        # Copies into the ring's preallocated slots, so always-on tracing doesn't allocate per frame
+        if self._tracer is not None and self._tracer.enabled:
+            self._tracer.record_bytes(event, data)
+
     def connection_made(self, transport):
         self._transport = transport
+        self._trace('connection_made')
         self._run_callback('connection_made')
 
     def data_received(self, data):
-        packets = self._e0d0ctx.decode(data)
-        for p in packets:
+        packets = self._e0d0ctx.decode_frames(data)
+        for start, p in packets:
+            if start:
+                self._begin_packet()
             self._stitch_and_dispatch(p)
 
     def connection_lost(self, exc: T.Optional[Exception]):
+        self._trace('connection_lost', exc)
         if exc is None:
             self._logger.info('Connection closed')
         else:
             self._logger.exception('Unexpected connection lost', exc_info=exc)
         self._run_callback('connection_lost', exc=exc)
 
+    def _handle_bad_checksum(self):
+        pass
+
+    def send_cmd(self, cmd, args=None):
+        self._write_frame(_encode_frame(self._e0d0ctx, self._cksumctx_tx, cmd, args))
+
+    def _write_frame(self, frame):
+        if self._logger.isEnabledFor(TRACE):
+            self._logger.trace('Send: %r', frame)
+        self._trace_bytes('tx', frame)
+        # TODO: possible error handling
+        self._transport.write(frame)
+
+    def _reset_partial_packet(self):
+        self._rx_len = 0
+
+    def _begin_packet(self):
+        # Sync received. Anything buffered at this point belongs to a truncated packet.
+        if self._rx_len != 0:
+            self._logger.debug('Dropping incomplete packet')
+            if self._tracer is not None and self._tracer.enabled:
+                self._tracer.record_bytes('drop_incomplete', self._rx_view[:self._rx_len])
+            self.rx_dropped += 1
+            self._reset_partial_packet()
+        self._discarding = False
+        self._discarded = False
+
+    def _discard(self):
+        # Count each run of junk between a packet and the next sync once, no matter how it is chunked
+        if not self._discarded:
+            self._logger.debug('Discarding data outside of packet until next sync')
+            self._discarded = True
+            self.rx_dropped += 1
+
+    def _stitch_and_dispatch(self, packet):
+        # Outside of a packet, wait for the next sync to resynchronize
+        if self._discarding:
+            if len(packet) != 0:
+                self._discard()
+                self._trace_bytes('drop_trailing', packet)
+            return
+
+        rx_len = self._rx_len
+        new_len = rx_len + len(packet)
+        if new_len > MAX_PACKET_LEN:
+            # Can't be a valid packet anymore, keep what fits so the length check below catches it
+            packet = packet[:MAX_PACKET_LEN - rx_len]
+            new_len = MAX_PACKET_LEN
+        # Copy through the view, assigning to a bytearray slice makes a temporary copy
+        self._rx_view[rx_len:new_len] = packet
+        self._rx_len = new_len
+
+        # if there is not enough bytes, wait for more
+        if new_len < 2:
+            return
+
+        # Index 0: cmd
+        # Index 1: argc
+        # Index 2-n: argv
+        # Index n+1: checksum
+        packet_len = self._rx_buf[1] + 3
+
+        if packet_len <= new_len:
+            if packet_len < new_len:
+                # Anything after the packet and before the next sync is garbage
+                self._discard()
+                if self._tracer is not None and self._tracer.enabled:
+                    self._tracer.record_bytes('drop_trailing', self._rx_view[packet_len:new_len])
+            stitched = self._rx_view[:packet_len]
+            self._trace_bytes('rx', stitched)
+            # Verified here rather than in the decoder: the checksummed region is only known
+            # once argc has been read from the stitched packet, which may span several chunks
+            cksum = self._cksumctx_rx.compute(stitched)
+            if cksum != 0:
+                # Warn, discard packet and return
+                self._logger.error('Bad checksum (expecting 0x%02x, got 0x%02x)', stitched[-1], (cksum + stitched[-1]) & 0xff)
+                self._trace('bad_checksum')
+                self._handle_bad_checksum()
+            else:
+                # Proceed to dispatch
+                # Handlers receive a view into the receive buffer and must copy anything they want to keep
+                cmd = stitched[0]
+                args = stitched[2:-1]
+                if cmd in self._dispatch:
+                    if self._logger.isEnabledFor(TRACE):
+                        self._logger.trace('cmd 0x%02x args %r', cmd, bytes(args))
+                    self._dispatch[cmd](cmd, args)
+                else:
+                    self._logger.warning('Unknown cmd 0x%02x args %r', cmd, bytes(args))
+
+            # cleanup
+            self._reset_partial_packet()
+            self._discarding = True
+
+
+class SliderDevice(_SliderProtocolBase):
+    def __init__(self, mode='diva', tracer: T.Optional[tracering.TraceRing] = None, profiles: ProfileRegistry = PROFILES):
+        if mode not in profiles:
+            raise ValueError(f'Unsupported mode {mode}')
+        super().__init__('SliderDevice', tracer)
+        self._mode = mode
+        self._profile = profiles[mode]
+        # Common commands
+        self._dispatch = {
+            SliderCommand.input_report: self._handle_input_report_one_shot,
+            SliderCommand.led_report: self._handle_led_report,
+            SliderCommand.enable_slider_report: self._handle_enable_slider_report,
+            SliderCommand.disable_slider_report: self._handle_disable_slider_report,
+            SliderCommand.reset: self._handle_reset,
+            SliderCommand.get_hw_info: self._handle_get_hw_info,
+        }
+        # Mode-specific commands
+        for cmd in self._profile.empty_response_commands:
+            self._dispatch[cmd] = self._handle_empty_response
+
     def _handle_input_report_one_shot(self, cmd, args):
         self._logger.trace('One-shot input report request')
         self._run_callback('report_oneshot')
 
     def _handle_led_report(self, cmd, args):
         self._logger.trace('New led report')
-        # Copies the data to the queue
-        report = dict(brightness=args[0], led_brg=bytes(args[1:]))
-        self._run_callback('led', report=report)
+        if len(args) < 1:
+            self._logger.warning('Malformed led report')
+            return
+        # The LED data is a view into the receive buffer, callbacks must copy anything they want to keep
+        self._run_callback('led', args[0], args[1:])
 
     def _handle_enable_slider_report(self, cmd, args):
         self._logger.debug('Open sesame')
@@ -160,105 +399,292 @@ class SliderDevice(asyncio.Protocol):
     def _handle_disable_slider_report(self, cmd, args):
         self._logger.debug('Close sesame')
         self._run_callback('report_state_change', enabled=False)
-        self.send_cmd(SliderCommand.disable_slider_report)
+        self._send_cached_response(SliderCommand.disable_slider_report)
 
     def _handle_reset(self, cmd, args):
         self._logger.debug('Reset')
         self._run_callback('reset')
-        self.send_cmd(cmd)
+        self._send_cached_response(cmd)
 
     def _handle_empty_response(self, cmd, args):
-        self.send_cmd(cmd)
+        self._send_cached_response(cmd)
 
     def _handle_get_hw_info(self, cmd, args):
         self._logger.debug('get hardware info')
-        self.send_cmd(cmd, HW_INFO[self._mode])
+        self._send_cached_response(cmd)
 
     def send_input_report(self, report):
         self.send_cmd(SliderCommand.input_report, report)
 
     def send_exception(self, code1):
-        response = bytearray(2)
-        response[0] = 0xff
-        response[1] = code1
-        self.send_cmd(SliderCommand.exception, bytes(response))
-
-    def send_cmd(self, cmd, args=None):
-        self._cksumctx_tx.reset()
-        buf = io.BytesIO()
-        cmd_byte = cmd.to_bytes(1, 'big')
-        len_byte = len(args).to_bytes(1, 'big') if args is not None else b'\x00'
-        buf.write(self._e0d0ctx.encode(cmd_byte))
-        self._cksumctx_tx.update(cmd_byte)
-        buf.write(self._e0d0ctx.encode(len_byte))
-        self._cksumctx_tx.update(len_byte)
-        if args != None:
-            buf.write(self._e0d0ctx.encode(args))
-            self._cksumctx_tx.update(args)
-        buf.write(self._e0d0ctx.finalize(self._cksumctx_tx.getvalue().to_bytes(1, 'big')))
-        self._logger.trace('Reply: %s', repr(buf.getvalue()))
-        # TODO: possible error handling
-        self._transport.write(buf.getbuffer())
-
-    def _stitch_and_dispatch(self, packet):
-        self._partial_packets.write(packet)
-        self._cksumctx_rx.update(packet)
-
-        # if there is not enough bytes, wait for more
-        if self._partial_packets.tell() < 2:
-            return
-
-        # Index 0: cmd
-        # Index 1: argc
-        # Index 2-n: argv
-        # Index n+1: checksum
-        argc = self._partial_packets.getbuffer()[1]
-        packet_len = argc + 3
-
-        assert packet_len >= self._partial_packets.tell(), 'Stitched packet is larger than expected'
-
-        if packet_len == self._partial_packets.tell():
-            stitched = self._partial_packets.getbuffer()
-            assert packet_len == len(stitched)
-            if self._cksumctx_rx.getvalue() != 0:
-                # Warn, discard packet and return
-                self._logger.error('Bad checksum (expecting 0x%02x, got 0x%02x)', stitched[-1], (self._cksumctx_rx.getvalue() + stitched[-1]) & 0xff)
-                self.send_exception(ExceptionCode1.wrong_checksum)
-            else:
-                # Proceed to dispatch
-                cmd = stitched[0]
-                args = stitched[2:-1]
-                if cmd in self._dispatch:
-                    self._logger.trace('cmd 0x%02x args %s', cmd, repr(bytes(args)))
-                    self._dispatch[cmd](cmd, args)
-                else:
-                    self._logger.warning('Unknown cmd 0x%02x args %s', cmd, repr(bytes(args)))
-                    # manually free the memoryviews
-                del args
-            del stitched
-
-            # cleanup
-            self._partial_packets.close()
-            del self._partial_packets
-            self._partial_packets = io.BytesIO()
-            self._cksumctx_rx.reset()
-
+        self.send_cmd(SliderCommand.exception, bytes((0xff, code1)))
+
+    def _send_cached_response(self, cmd):
+        self._write_frame(self._profile.responses[cmd])
+
+    def _handle_bad_checksum(self):
+        self.send_exception(ExceptionCode1.wrong_checksum)
+
+
+InputReport = namedtuple('InputReport', ('timestamp', 'data'))
+
+
+class SliderHost(_SliderProtocolBase):
+    '''
+    Host (game) side of the link, mirroring SliderDevice. Requests are
+    coroutines that complete when the device replies, and input reports can be
+    consumed with "async for report in host.reports()". Reports are timestamped
+    with clock when they arrive. If the consumer falls behind, the oldest
+    queued reports are dropped.
+    '''
+    def __init__(self, timeout: float = 1.0, max_queued_reports: int = 1024, tracer: T.Optional[tracering.TraceRing] = None,
+                 clock: T.Callable[[], float] = time.monotonic):
+        super().__init__('SliderHost', tracer)
+        self.timeout = timeout
+        self._clock = clock
+        self._closed = False
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+        # Waiting requests per reply command, oldest first
+        self._pending = {}
+        self._reports = collections.deque(maxlen=max_queued_reports)
+        self._reports_ready = asyncio.Event()
+        self.reports_received = 0
+        self.reports_dropped = 0
+        self.exceptions = 0
+        self._dispatch = {
+            SliderCommand.input_report: self._handle_input_report,
+            SliderCommand.exception: self._handle_exception,
+            SliderCommand.get_hw_info: self._handle_reply,
+            SliderCommand.reset: self._handle_reply,
+            SliderCommand.disable_slider_report: self._handle_reply,
+        }
 
-async def create_rfcomm_connection(loop: asyncio.BaseEventLoop, protocol_factory: asyncio.Protocol, bdaddr: str, channel: int) -> T.Tuple[asyncio.Transport, asyncio.Protocol]:
+    def connection_lost(self, exc: T.Optional[Exception]):
+        self._closed = True
+        for waiters in self._pending.values():
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(ConnectionError('Connection lost') if exc is None else exc)
+        self._pending.clear()
+        # Wake up writers and end report iteration once the queued reports are consumed
+        self._can_write.set()
+        self._reports_ready.set()
+        super().connection_lost(exc)
+
+    def pause_writing(self):
+        self._can_write.clear()
+
+    def resume_writing(self):
+        self._can_write.set()
+
+    def _check_connected(self):
+        if self._transport is None or self._closed:
+            raise ConnectionError('Not connected')
+
+    async def _drain(self):
+        if not self._can_write.is_set():
+            await self._can_write.wait()
+        self._check_connected()
+
+    async def _request(self, cmd: int, args: T.Optional[bytes] = None) -> bytes:
+        self._check_connected()
+        waiter = asyncio.get_running_loop().create_future()
+        waiters = self._pending.setdefault(cmd, collections.deque())
+        waiters.append(waiter)
+        self.send_cmd(cmd, args)
+        try:
+            return await asyncio.wait_for(waiter, self.timeout)
+        finally:
+            # Timed out or cancelled
+            if waiter in waiters:
+                waiters.remove(waiter)
+
+    def _handle_reply(self, cmd, args):
+        waiters = self._pending.get(cmd)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(bytes(args))
+                return
+        self._logger.debug('Unsolicited reply to cmd 0x%02x', cmd)
+
+    def _handle_exception(self, cmd, args):
+        self.exceptions += 1
+        code1 = args[1] if len(args) >= 2 else None
+        self._logger.warning('Device reported exception %r', code1)
+        self._run_callback('exception', code1=code1)
+
+    def _handle_input_report(self, cmd, args):
+        self.reports_received += 1
+        self._queue_report(InputReport(self._clock(), bytes(args)))
+
+    def _queue_report(self, report):
+        # Full deque drops the oldest report on append
+        if len(self._reports) == self._reports.maxlen:
+            self.reports_dropped += 1
+        self._reports.append(report)
+        self._reports_ready.set()
+
+    async def reports(self) -> T.AsyncIterator[InputReport]:
+        '''Incoming input reports, oldest first. Ends when the connection is lost.'''
+        while True:
+            while self._reports:
+                yield self._reports.popleft()
+            if self._closed:
+                return
+            self._reports_ready.clear()
+            await self._reports_ready.wait()
+
+    async def get_hw_info(self) -> SliderHardwareInfo:
+        args = await self._request(SliderCommand.get_hw_info)
+        if len(args) != _hwinfo_packer.size:
+            raise ValueError(f'Malformed hardware info {args!r}')
+        return SliderHardwareInfo._make(_hwinfo_packer.unpack(args))
+
+    async def reset(self) -> None:
+        await self._request(SliderCommand.reset)
+
+    async def enable_reports(self) -> None:
+        # The device does not reply, reports just start to flow
+        self._check_connected()
+        self.send_cmd(SliderCommand.enable_slider_report)
+        await self._drain()
+
+    async def disable_reports(self) -> None:
+        await self._request(SliderCommand.disable_slider_report)
+
+    async def send_led(self, brightness: int, led_brg: bytes) -> None:
+        '''Send an LED report. Waits for the transport to drain if it is backed up.'''
+        self._check_connected()
+        self.send_cmd(SliderCommand.led_report, bytes((brightness,)) + led_brg)
+        await self._drain()
+
+
+class BluetoothBackend(object):
+    '''
+    Blocking Bluetooth primitives used by the RFCOMM transport. Backed by
+    PyBluez by default and can be replaced (e.g. with a fake one for testing).
+    PyBluez is only imported when the default backend is created, so
+    everything else works without it.
+    '''
+    def __init__(self) -> None:
+        try:
+            import bluetooth
+        except ImportError as e:
+            raise ImportError('PyBluez is required for RFCOMM connections') from e
+        self._bluetooth = bluetooth
+        self.serial_port_class = bluetooth.SERIAL_PORT_CLASS
+
+    def find_service(self, bdaddr: str, name: T.Optional[str] = None, uuid: T.Optional[str] = None) -> T.List[T.Dict[str, T.Any]]:
+        filter_ = {}
+        if name is not None:
+            filter_['name'] = name
+        if uuid is not None:
+            filter_['uuid'] = uuid
+        return self._bluetooth.find_service(address=bdaddr, **filter_)
+
+    def connect(self, bdaddr: str, channel: int):
+        sock = self._bluetooth.BluetoothSocket(self._bluetooth.RFCOMM)
+        try:
+            sock.connect((bdaddr, channel))
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+
+class SDPCache(object):
+    '''
+    Caches resolved RFCOMM channels per (bdaddr, name, uuid) for ttl seconds.
+    '''
+    def __init__(self, ttl: float = 300.0, clock: T.Callable[[], float] = time.monotonic) -> None:
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = {}
+
+    def get(self, key: T.Tuple[str, T.Optional[str], T.Optional[str]]) -> T.Optional[int]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        channel, expires = entry
+        if self._clock() >= expires:
+            del self._entries[key]
+            return None
+        return channel
+
+    def put(self, key: T.Tuple[str, T.Optional[str], T.Optional[str]], channel: int) -> None:
+        self._entries[key] = (channel, self._clock() + self.ttl)
+
+    def invalidate(self, key: T.Tuple[str, T.Optional[str], T.Optional[str]]) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+_default_bt_backend = None
+_default_sdp_cache = SDPCache()
+
+
+def _get_default_bt_backend() -> BluetoothBackend:
+    global _default_bt_backend
+    if _default_bt_backend is None:
+        _default_bt_backend = BluetoothBackend()
+    return _default_bt_backend
+
+
+async def resolve_rfcomm_channel(loop: asyncio.BaseEventLoop, bdaddr: str, name: T.Optional[str] = None, uuid: T.Optional[str] = None,
+                                 bt_backend: T.Optional[BluetoothBackend] = None, sdp_cache: T.Optional[SDPCache] = None) -> int:
+    bt_backend = bt_backend or _get_default_bt_backend()
+    sdp_cache = sdp_cache if sdp_cache is not None else _default_sdp_cache
+    key = (bdaddr, name, uuid)
+    channel = sdp_cache.get(key)
+    if channel is not None:
+        _logger.debug('SDP: Using cached channel %d for %s', channel, bdaddr)
+        return channel
+
+    _logger.debug('SDP: Resolving service on %s', bdaddr)
+    start = time.monotonic()
+    # SDP lookups can take seconds so keep them off the event loop
+    services = await loop.run_in_executor(None, bt_backend.find_service, bdaddr, name, uuid)
+    _logger.info('SDP: Lookup on %s took %.3fs', bdaddr, time.monotonic() - start)
+
+    for svc in services:
+        # TODO match classes?
+        if bt_backend.serial_port_class in svc['service-classes']:
+            _logger.debug('SDP: Found service "%s" on channel %d', svc['name'], svc['port'])
+            sdp_cache.put(key, svc['port'])
+            return svc['port']
+    raise ValueError('No matching service found')
+
+
+async def create_rfcomm_connection(loop: asyncio.BaseEventLoop, protocol_factory: asyncio.Protocol, bdaddr: str, channel: int,
+                                   bt_backend: T.Optional[BluetoothBackend] = None) -> T.Tuple[asyncio.Transport, asyncio.Protocol]:
+    bt_backend = bt_backend or _get_default_bt_backend()
     _logger.debug('RFCOMM: Connecting to device %s channel %d', bdaddr, channel)
-    sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-    sock.connect((bdaddr, channel))
-    return await loop.create_connection(protocol_factory, sock=sock)
-
-
-async def create_connection(loop: asyncio.BaseEventLoop, uri: str, mode: T.Optional[str]='diva') -> T.Tuple[asyncio.Transport, SliderDevice]:
+    start = time.monotonic()
+    sock = await loop.run_in_executor(None, bt_backend.connect, bdaddr, channel)
+    try:
+        result = await loop.create_connection(protocol_factory, sock=sock)
+    except Exception:
+        sock.close()
+        raise
+    _logger.info('RFCOMM: Connected to device %s channel %d in %.3fs', bdaddr, channel, time.monotonic() - start)
+    return result
+
+
+async def create_connection(loop: asyncio.BaseEventLoop, uri: str, mode: T.Optional[str]='diva',
+                            bt_backend: T.Optional[BluetoothBackend] = None, sdp_cache: T.Optional[SDPCache] = None,
+                            tracer: T.Optional[tracering.TraceRing] = None) -> T.Tuple[asyncio.Transport, SliderDevice]:
     parsed_uri = urllib.parse.urlparse(uri)
+    protocol_factory = lambda: SliderDevice(mode, tracer)
     # tcp://127.0.0.1:12345 or tcp://[::1]:12345
     if parsed_uri.scheme == 'tcp':
-        return await loop.create_connection(lambda: SliderDevice(mode), parsed_uri.hostname, parsed_uri.port or 12345)
+        return await loop.create_connection(protocol_factory, parsed_uri.hostname, parsed_uri.port or 12345)
     # serial:COM0 or serial:///dev/ttyUSB0 or serial:/dev/ttyUSB0
     elif parsed_uri.scheme == 'serial':
-        return await serial_asyncio.create_serial_connection(loop, lambda: SliderDevice(mode), parsed_uri.path, baudrate=115200)
+        return await serial_asyncio.create_serial_connection(loop, protocol_factory, parsed_uri.path, baudrate=115200)
     # rfcomm://11-22-33-44-55-66:1 or rfcomm://11-22-33-44-55-66/sdp?[name=<name>][&uuid=<uuid>] or
     # rfcomm://[fe80::1122:33ff:fe44:5566]:1 or rfcomm://[fe80::1122:33ff:fe44:5566]/sdp?[name=<name>][&uuid=<uuid>]
     elif parsed_uri.scheme == 'rfcomm':
@@ -273,31 +699,21 @@ async def create_connection(loop: asyncio.BaseEventLoop, uri: str, mode: T.Optio
                     raise ipaddress.AddressValueError('Invalid IID for 6LN IPv6 link-local address.')
                 bdaddr = ':'.join(f'{b:02x}' for b in itertools.chain(sixln_ipv6_addr.packed[8:11], sixln_ipv6_addr.packed[13:16]))
 
-            channel = None
             params = urllib.parse.parse_qs(parsed_uri.query)
-            _logger.debug('SDP: Resolving service on %s', bdaddr)
-
-            filter_ = {}
-            if 'name' in params:
-                filter_['name'] = params['name'][0]
-            if 'uuid' in params:
-                filter_['uuid'] = params['uuid'][0]
-            services = bluetooth.find_service(address=bdaddr, **filter_)
-
-            for svc in services:
-                # TODO match classes?
-                if bluetooth.SERIAL_PORT_CLASS in svc['service-classes']:
-                    _logger.debug('SDP: Found service "%s" on channel %d', svc['name'], svc['port'])
-                    channel = svc['port']
-                    break
-            if channel is None:
-                raise ValueError('No matching service found')
-            else:
-                return await create_rfcomm_connection(loop, lambda: SliderDevice(mode), bdaddr, channel)
+            name = params['name'][0] if 'name' in params else None
+            uuid = params['uuid'][0] if 'uuid' in params else None
+            sdp_cache = sdp_cache if sdp_cache is not None else _default_sdp_cache
+            channel = await resolve_rfcomm_channel(loop, bdaddr, name, uuid, bt_backend, sdp_cache)
+            try:
+                return await create_rfcomm_connection(loop, protocol_factory, bdaddr, channel, bt_backend)
+            except Exception:
+                # The service might have moved to another channel
+                sdp_cache.invalidate((bdaddr, name, uuid))
+                raise
         elif parsed_uri.path != '/' and parsed_uri.path != '':
             raise ValueError('Unsupported URI {}'.format(uri))
         else:
-            return await create_rfcomm_connection(loop, lambda: SliderDevice(mode), parsed_uri.hostname.replace('-', ':'), parsed_uri.port or 1)
+            return await create_rfcomm_connection(loop, protocol_factory, parsed_uri.hostname.replace('-', ':'), parsed_uri.port or 1, bt_backend)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
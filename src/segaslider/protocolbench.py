@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+'''
+Protocol throughput benchmarks.
+
+Usage: python -m segaslider.protocolbench [--save baseline.json] [--baseline baseline.json]
+'''
+
+import typing as T
+
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+
+from . import profiler
+from . import protocol
+from .protocol import encode_frame
+from .helper import checksum
+from .helper import e0d0
+from .helper import tracering
+
+BENCHMARKS = {}
+
+# Worst-ish case LED report: a third of the payload needs escaping
+LED_PAYLOAD = bytes((63,)) + bytes((0xff, 0x12, 0xfd)) * 32
+
+
+def benchmark(name: str):
+    def _register(func):
+        BENCHMARKS[name] = func
+        return func
+    return _register
+
+
+class NullTransport(object):
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+    def is_closing(self):
+        return False
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--profile', metavar='PREFIX', help='Sample the run and export the profile to PREFIX.collapsed and PREFIX.txt')
+    parser.add_argument('--profile-rate', type=float, default=100.0, help='Profiler sampling rate in Hz (default: 100.0)')
+
+
+@contextlib.contextmanager
+def profiled(args: argparse.Namespace) -> T.Iterator[T.Optional[profiler.SamplingProfiler]]:
+    '''Sample the calling thread while in the context if --profile was given.'''
+    if args.profile is None:
+        yield None
+        return
+    sampler = profiler.SamplingProfiler(args.profile_rate)
+    sampler.start()
+    try:
+        yield sampler
+    finally:
+        sampler.stop()
+        print(f'Profile saved to {", ".join(sampler.export(args.profile))}')
+
+
+def make_device(mode: str = 'diva', tracer: T.Optional[tracering.TraceRing] = None) -> T.Tuple[protocol.SliderDevice, NullTransport]:
+    transport = NullTransport()
+    device = protocol.SliderDevice(mode, tracer=tracer)
+    device.connection_made(transport)
+    return device, transport
+
+
+@benchmark('rx_led_report')
+def bench_rx_led_report(size: int, chunk_size: int = 4096) -> T.Tuple[int, int, float]:
+    '''Receive a stream of LED reports'''
+    frame = encode_frame(protocol.SliderCommand.led_report, LED_PAYLOAD)
+    count = max(size // len(frame), 1)
+    stream = frame * count
+    device, _transport = make_device()
+    device.on('led', lambda brightness, led_brg: None)
+    start = time.perf_counter()
+    for i in range(0, len(stream), chunk_size):
+        device.data_received(stream[i:i+chunk_size])
+    return len(stream), count, time.perf_counter() - start
+
+
+@benchmark('tx_input_report')
+def bench_tx_input_report(size: int) -> T.Tuple[int, int, float]:
+    '''Send input reports'''
+    device, transport = make_device()
+    report = bytearray(32)
+    count = 0
+    start = time.perf_counter()
+    while transport.bytes_written < size:
+        report[count % 32] ^= 0xfe
+        device.send_input_report(report)
+        count += 1
+    return transport.bytes_written, count, time.perf_counter() - start
+
+
+# Frame builder and decoder as they were before checksumming and escaping were done in bulk,
+# kept as a reference point for the framing benchmarks.
+def legacy_encode_frame(e0d0ctx: e0d0.E0D0Context, cksumctx: checksum.BaseJVSChecksum, cmd: int, args: T.Optional[bytes] = None) -> bytes:
+    cksumctx.reset()
+    buf = io.BytesIO()
+    cmd_byte = cmd.to_bytes(1, 'big')
+    len_byte = len(args).to_bytes(1, 'big') if args is not None else b'\x00'
+    buf.write(legacy_encode(e0d0ctx, cmd_byte))
+    cksumctx.update(cmd_byte)
+    buf.write(legacy_encode(e0d0ctx, len_byte))
+    cksumctx.update(len_byte)
+    if args is not None:
+        buf.write(legacy_encode(e0d0ctx, args))
+        cksumctx.update(args)
+    buf.write(legacy_encode(e0d0ctx, cksumctx.getvalue().to_bytes(1, 'big')))
+    e0d0ctx.reset_encoder()
+    return buf.getvalue()
+
+
+def legacy_encode(e0d0ctx: e0d0.E0D0Context, data: bytes) -> bytes:
+    result = bytearray()
+    if not e0d0ctx.encoder_is_in_transaction:
+        result.append(e0d0ctx.sync)
+        e0d0ctx.encoder_is_in_transaction = True
+    for b in data:
+        if b in (e0d0ctx.sync, e0d0ctx.esc):
+            result.append(e0d0ctx.esc)
+            result.append((b-1) & 0xff)
+        else:
+            result.append(b)
+    return bytes(result)
+
+
+def legacy_decode(e0d0ctx: e0d0.E0D0Context, data: bytes) -> T.Tuple[bytes]:
+    result = list()
+    decoded_cur = bytearray()
+    for b in data:
+        if b == e0d0ctx.sync:
+            e0d0ctx.reset_decoder()
+            if len(decoded_cur) != 0:
+                result.append(bytes(decoded_cur))
+                decoded_cur = bytearray()
+        elif b == e0d0ctx.esc:
+            e0d0ctx.decoder_is_escaping = True
+        elif e0d0ctx.decoder_is_escaping:
+            decoded_cur.append((b+1) & 0xff)
+            e0d0ctx.decoder_is_escaping = False
+        else:
+            decoded_cur.append(b)
+    result.append(bytes(decoded_cur))
+    return tuple(result)
+
+
+def _bench_encode(size: int, encoder) -> T.Tuple[int, int, float]:
+    e0d0ctx = e0d0.E0D0Context(sync=0xff, esc=0xfd)
+    cksumctx = checksum.NegativeJVSChecksum(init=-0xff)
+    nbytes = 0
+    count = 0
+    start = time.perf_counter()
+    while nbytes < size:
+        nbytes += len(encoder(e0d0ctx, cksumctx, protocol.SliderCommand.led_report, LED_PAYLOAD))
+        count += 1
+    return nbytes, count, time.perf_counter() - start
+
+
+@benchmark('tx_frame')
+def bench_tx_frame(size: int) -> T.Tuple[int, int, float]:
+    '''Build LED report frames (bulk checksum and escape)'''
+    return _bench_encode(size, protocol._encode_frame)
+
+
+@benchmark('tx_frame_legacy')
+def bench_tx_frame_legacy(size: int) -> T.Tuple[int, int, float]:
+    '''Build LED report frames (separate per-field passes)'''
+    return _bench_encode(size, legacy_encode_frame)
+
+
+def _bench_decode(size: int, decoder, chunk_size: int = 4096) -> T.Tuple[int, int, float]:
+    frame = encode_frame(protocol.SliderCommand.led_report, LED_PAYLOAD)
+    count = max(size // len(frame), 1)
+    stream = frame * count
+    e0d0ctx = e0d0.E0D0Context(sync=0xff, esc=0xfd)
+    cksumctx = checksum.NegativeJVSChecksum(init=-0xff)
+    start = time.perf_counter()
+    for i in range(0, len(stream), chunk_size):
+        decoder(e0d0ctx, cksumctx, stream[i:i+chunk_size])
+    return len(stream), count, time.perf_counter() - start
+
+
+def _decode_and_verify(e0d0ctx: e0d0.E0D0Context, cksumctx: checksum.BaseJVSChecksum, data: bytes) -> None:
+    for _start, packet in e0d0ctx.decode_frames(data):
+        cksumctx.compute(packet)
+
+
+def _legacy_decode_and_verify(e0d0ctx: e0d0.E0D0Context, cksumctx: checksum.BaseJVSChecksum, data: bytes) -> None:
+    for packet in legacy_decode(e0d0ctx, data):
+        cksumctx.update(packet)
+
+
+@benchmark('rx_decode')
+def bench_rx_decode(size: int) -> T.Tuple[int, int, float]:
+    '''Decode and checksum LED report frames (bulk)'''
+    return _bench_decode(size, _decode_and_verify)
+
+
+@benchmark('rx_decode_legacy')
+def bench_rx_decode_legacy(size: int) -> T.Tuple[int, int, float]:
+    '''Decode and checksum LED report frames (byte by byte)'''
+    return _bench_decode(size, _legacy_decode_and_verify)
+
+
+def run(names: T.Iterable[str], size: int, repeat: int) -> T.Dict[str, T.Dict[str, float]]:
+    results = {}
+    for name in names:
+        # Best of N to reduce noise
+        nbytes, frames, elapsed = min((BENCHMARKS[name](size) for _ in range(repeat)), key=lambda r: r[2])
+        results[name] = dict(
+            mb_per_s=nbytes / elapsed / 1e6,
+            frames_per_s=frames / elapsed,
+        )
+    return results
+
+
+def compare(results: T.Mapping[str, T.Mapping[str, float]], baseline: T.Mapping[str, T.Mapping[str, float]], tolerance: float) -> bool:
+    ok = True
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['frames_per_s'] / baseline[name]['frames_per_s']
+        regressed = ratio < 1.0 - tolerance
+        ok = ok and not regressed
+        print(f'{name}: {ratio:.2f}x baseline{" (REGRESSED)" if regressed else ""}')
+    return ok
+
+
+def main(argv: T.Optional[T.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Slider protocol throughput benchmarks.')
+    parser.add_argument('names', nargs='*', default=list(BENCHMARKS.keys()), help='Benchmarks to run (default: all)')
+    parser.add_argument('--size', type=int, default=4 << 20, help='Bytes per run (default: 4MiB)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark (default: 3)')
+    parser.add_argument('--save', help='Save results as baseline to this file')
+    parser.add_argument('--baseline', help='Compare results against this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against baseline (default: 0.2)')
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f'Unknown benchmark {name}')
+
+    with profiled(args):
+        results = run(args.names, args.size, args.repeat)
+    for name, result in results.items():
+        print(f'{name}: {result["mb_per_s"]:.2f} MB/s, {result["frames_per_s"]:.0f} frames/s')
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
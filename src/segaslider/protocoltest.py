@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+
+import asyncio
+import collections
+import json
+import os
+import random
+import tempfile
+import socket
+import time
+import tracemalloc
+import unittest
+from segaslider import loadgen, protocol, soakbench
+from segaslider.helper import checksum, e0d0, tracering
+
+def encode_frame(cmd, args=b'', corrupt=False):
+    '''Encode a host-to-device frame'''
+    ctx = e0d0.E0D0Context(sync=0xff, esc=0xfd)
+    cksum = checksum.NegativeJVSChecksum(init=-0xff)
+    body = bytes((cmd, len(args))) + args
+    cksum.update(body)
+    value = cksum.getvalue() ^ (0x5a if corrupt else 0)
+    return ctx.finalize(body + bytes((value,)))
+
+def random_chunks(rng, data, max_size=64):
+    '''Split data at random points'''
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(1, max_size)
+        yield data[pos:pos+size]
+        pos += size
+
+class FakeTransport(object):
+    def __init__(self):
+        self.written = bytearray()
+        self.writes = 0
+
+    def write(self, data):
+        self.written += data
+        self.writes += 1
+
+    def is_closing(self):
+        return False
+
+class DeviceHarness(object):
+    '''SliderDevice wired to a fake transport that records callbacks'''
+    def __init__(self, mode='diva', tracer=None):
+        self.transport = FakeTransport()
+        self.device = protocol.SliderDevice(mode, tracer)
+        self.leds = []
+        self.resets = 0
+        self.device.on('led', lambda brightness, led_brg: self.leds.append(bytes(led_brg)))
+        self.device.on('reset', self._on_reset)
+        self.device.connection_made(self.transport)
+
+    def _on_reset(self):
+        self.resets += 1
+
+    def feed(self, chunks):
+        for chunk in chunks:
+            self.device.data_received(chunk)
+
+    def replies(self):
+        return tuple(p for p in e0d0.E0D0Context(sync=0xff, esc=0xfd).decode(bytes(self.transport.written)) if p)
+
+class FakeBluetoothBackend(protocol.BluetoothBackend):
+    '''Stands in for PyBluez. Connections are backed by local socket pairs.'''
+    serial_port_class = '1101'
+
+    def __init__(self, services=None, fail_connect=False):
+        self.services = services if services is not None else [dict(name='SegaSlider', port=3, **{'service-classes': ['1101']})]
+        self.fail_connect = fail_connect
+        self.sdp_queries = 0
+        self.connects = []
+        self.peers = []
+
+    def find_service(self, bdaddr, name=None, uuid=None):
+        self.sdp_queries += 1
+        return [svc for svc in self.services if name is None or svc['name'] == name]
+
+    def connect(self, bdaddr, channel):
+        self.connects.append((bdaddr, channel))
+        if self.fail_connect:
+            raise OSError('Host is down')
+        sock, peer = socket.socketpair()
+        self.peers.append(peer)
+        return sock
+
+    def close(self):
+        for peer in self.peers:
+            peer.close()
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestSDPCache(unittest.TestCase):
+    def test_ttl(self):
+        '''Entries expire after TTL'''
+        clock = FakeClock()
+        cache = protocol.SDPCache(ttl=10.0, clock=clock)
+        cache.put(('11:22:33:44:55:66', None, None), 3)
+        self.assertEqual(cache.get(('11:22:33:44:55:66', None, None)), 3)
+        clock.now = 10.0
+        self.assertIsNone(cache.get(('11:22:33:44:55:66', None, None)))
+
+    def test_invalidate(self):
+        '''Invalidate drops the entry'''
+        cache = protocol.SDPCache()
+        cache.put(('11:22:33:44:55:66', 'a', None), 3)
+        cache.invalidate(('11:22:33:44:55:66', 'a', None))
+        self.assertIsNone(cache.get(('11:22:33:44:55:66', 'a', None)))
+
+class TestRFCOMMConnection(unittest.IsolatedAsyncioTestCase):
+    async def test_connect_direct(self):
+        '''Direct RFCOMM connect'''
+        backend = FakeBluetoothBackend()
+        self.addCleanup(backend.close)
+        transport, proto = await protocol.create_connection(asyncio.get_running_loop(), 'rfcomm://11-22-33-44-55-66:2', bt_backend=backend)
+        self.addCleanup(transport.close)
+        self.assertIsInstance(proto, protocol.SliderDevice)
+        self.assertEqual(backend.connects, [('11:22:33:44:55:66', 2)])
+        self.assertEqual(backend.sdp_queries, 0)
+
+    async def test_connect_sdp_cached(self):
+        '''SDP results are cached across connects'''
+        backend = FakeBluetoothBackend()
+        self.addCleanup(backend.close)
+        cache = protocol.SDPCache()
+        for _ in range(2):
+            transport, _proto = await protocol.create_connection(asyncio.get_running_loop(), 'rfcomm://11-22-33-44-55-66/sdp?name=SegaSlider', bt_backend=backend, sdp_cache=cache)
+            transport.close()
+        self.assertEqual(backend.sdp_queries, 1)
+        self.assertEqual(backend.connects, [('11:22:33:44:55:66', 3)] * 2)
+
+    async def test_connect_sdp_failure_invalidates(self):
+        '''Failed connect invalidates the cached SDP result'''
+        backend = FakeBluetoothBackend(fail_connect=True)
+        cache = protocol.SDPCache()
+        with self.assertRaises(OSError):
+            await protocol.create_connection(asyncio.get_running_loop(), 'rfcomm://11-22-33-44-55-66/sdp', bt_backend=backend, sdp_cache=cache)
+        self.assertIsNone(cache.get(('11:22:33:44:55:66', None, None)))
+
+    async def test_connect_sdp_not_found(self):
+        '''No matching service'''
+        backend = FakeBluetoothBackend(services=[])
+        with self.assertRaisesRegex(ValueError, 'No matching service'):
+            await protocol.create_connection(asyncio.get_running_loop(), 'rfcomm://11-22-33-44-55-66/sdp', bt_backend=backend, sdp_cache=protocol.SDPCache())
+
+class TestReceiveFuzz(unittest.TestCase):
+    SEED = 0x5e6a
+
+    def setUp(self):
+        self.rng = random.Random(self.SEED)
+
+    def _random_led_payload(self):
+        # Bias towards bytes that need escaping
+        return bytes(self.rng.choice((0xff, 0xfd, self.rng.randrange(256))) for _ in range(96))
+
+    def _assert_subsequence(self, expected, actual):
+        it = iter(actual)
+        for item in expected:
+            self.assertIn(item, it)
+
+    def test_random_chunking(self):
+        '''Valid frames survive arbitrary chunking'''
+        payloads = [self._random_led_payload() for _ in range(500)]
+        stream = b''.join(encode_frame(protocol.SliderCommand.led_report, bytes((63,)) + p) for p in payloads)
+        for max_size in (1, 2, 7, 64, 4096):
+            with self.subTest(max_size=max_size):
+                harness = DeviceHarness()
+                harness.feed(random_chunks(self.rng, stream, max_size))
+                self.assertEqual(harness.leds, payloads)
+                self.assertEqual(harness.device.rx_dropped, 0)
+
+    def test_corrupted_checksum(self):
+        '''Bad checksums are reported and do not affect subsequent frames'''
+        frames = []
+        expected = []
+        corrupted = 0
+        for _ in range(300):
+            payload = self._random_led_payload()
+            corrupt = self.rng.random() < 0.3
+            frames.append(encode_frame(protocol.SliderCommand.led_report, bytes((63,)) + payload, corrupt))
+            if corrupt:
+                corrupted += 1
+            else:
+                expected.append(payload)
+        harness = DeviceHarness()
+        harness.feed(random_chunks(self.rng, b''.join(frames)))
+        self.assertEqual(harness.leds, expected)
+        replies = harness.replies()
+        self.assertEqual(len(replies), corrupted)
+        self.assertTrue(all(r[0] == protocol.SliderCommand.exception for r in replies))
+
+    def test_garbage_resync(self):
+        '''Truncated, overlong and badly escaped frames are dropped and the device resynchronizes'''
+        garbage_makers = (
+            # escape after escape
+            lambda: b'\xff\x02\x61\x3f\xfd\xfd' + bytes(self.rng.randrange(0xfd) for _ in range(10)),
+            # sync after escape
+            lambda: b'\xff\x02\x61\xfd',
+            # truncated frame
+            lambda: encode_frame(protocol.SliderCommand.led_report, bytes((63,)) + self._random_led_payload())[:self.rng.randrange(1, 90)],
+            # overlong frame
+            lambda: b'\xff\x10\x00' + bytes(self.rng.randrange(0xfd) for _ in range(20)),
+            # random noise
+            lambda: bytes(self.rng.randrange(256) for _ in range(self.rng.randrange(1, 200))),
+        )
+        stream = bytearray()
+        expected = []
+        for _ in range(500):
+            stream += self.rng.choice(garbage_makers)()
+            payload = self._random_led_payload()
+            expected.append(payload)
+            stream += encode_frame(protocol.SliderCommand.led_report, bytes((63,)) + payload)
+        harness = DeviceHarness()
+        harness.feed(random_chunks(self.rng, bytes(stream)))
+        self._assert_subsequence(expected, harness.leds)
+        self.assertGreater(harness.device.rx_dropped, 0)
+
+    def test_trailing_noise(self):
+        '''Noise between frames never produces replies, however it is chunked'''
+        frames = 200
+        stream = bytearray()
+        for _ in range(frames):
+            stream += encode_frame(protocol.SliderCommand.reset)
+            # Noise without sync or escape bytes, so it can't start a packet
+            stream += bytes(self.rng.randrange(0xfd) for _ in range(self.rng.randrange(1, 20)))
+        expected = (encode_frame(protocol.SliderCommand.reset)[1:],) * frames
+        for max_size in (1, 2, 3, 7, 64, len(stream)):
+            with self.subTest(max_size=max_size):
+                harness = DeviceHarness()
+                harness.feed(random_chunks(self.rng, bytes(stream), max_size))
+                self.assertEqual(harness.resets, frames)
+                self.assertEqual(harness.replies(), expected)
+                self.assertEqual(harness.device.rx_dropped, frames)
+
+    def test_short_led_report(self):
+        '''LED report without arguments is ignored'''
+        harness = DeviceHarness()
+        harness.feed((encode_frame(protocol.SliderCommand.led_report), encode_frame(protocol.SliderCommand.reset)))
+        self.assertEqual(harness.leds, [])
+        self.assertEqual(harness.resets, 1)
+
+class TestProfiles(unittest.TestCase):
+    CUSTOM_PROFILE = dict(custom=dict(
+        layout='chu',
+        hw_info=dict(model='12345   ', device_class=0xa0, chip_pn='00000', unk_0xe=0xff, fw_ver=0x91, unk_0x10=0x00, unk_0x11=0x64),
+        empty_response_commands=[0x09],
+    ))
+
+    def test_precomputed_responses(self):
+        '''Constant replies are written as a single precomputed buffer'''
+        harness = DeviceHarness('diva')
+        for cmd in (protocol.SliderCommand.get_hw_info, protocol.SliderCommand.reset, protocol.SliderCommand.disable_slider_report, protocol.SliderCommand.unk_0x09, protocol.SliderCommand.unk_0x0a):
+            with self.subTest(cmd=cmd):
+                writes = harness.transport.writes
+                written = len(harness.transport.written)
+                harness.feed((encode_frame(cmd),))
+                self.assertEqual(harness.transport.writes, writes + 1)
+                self.assertEqual(bytes(harness.transport.written[written:]), protocol.PROFILES['diva'].responses[cmd])
+
+    def test_hw_info(self):
+        '''Hardware info matches the profile'''
+        for mode, model in (('diva', b'15275   '), ('chu', b'15330   ')):
+            with self.subTest(mode=mode):
+                harness = DeviceHarness(mode)
+                harness.feed((encode_frame(protocol.SliderCommand.get_hw_info),))
+                reply, = harness.replies()
+                self.assertEqual(reply[:2], b'\xf0\x12')
+                self.assertEqual(reply[2:10], model)
+
+    def test_mode_specific_commands(self):
+        '''Only diva answers 0x09/0x0a'''
+        harness = DeviceHarness('chu')
+        harness.feed((encode_frame(protocol.SliderCommand.unk_0x09),))
+        self.assertEqual(harness.replies(), ())
+
+    def test_load(self):
+        '''Load profiles from JSON'''
+        registry = protocol.ProfileRegistry()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'profiles.json')
+            with open(path, 'w') as f:
+                json.dump(self.CUSTOM_PROFILE, f)
+            self.assertEqual(registry.load(path), ('custom',))
+        self.assertEqual(registry['custom'].layout, 'chu')
+        harness = DeviceHarness()
+        harness.device = protocol.SliderDevice('custom', profiles=registry)
+        harness.device.connection_made(harness.transport)
+        harness.feed((encode_frame(protocol.SliderCommand.get_hw_info), encode_frame(0x09)))
+        hw_info, empty = harness.replies()
+        self.assertEqual(hw_info[2:10], b'12345   ')
+        self.assertEqual(empty[:2], b'\x09\x00')
+
+    def test_load_malformed(self):
+        '''Malformed profiles are rejected'''
+        registry = protocol.ProfileRegistry()
+        for definition in (dict(layout='chu'), dict(self.CUSTOM_PROFILE['custom'], layout='maimai'), dict(self.CUSTOM_PROFILE['custom'], empty_response_commands=[0x100]),
+                           dict(self.CUSTOM_PROFILE['custom'], empty_response_commands=[protocol.SliderCommand.led_report]),
+                           dict(self.CUSTOM_PROFILE['custom'], hw_info=dict(self.CUSTOM_PROFILE['custom']['hw_info'], device_class=300)),
+                           dict(self.CUSTOM_PROFILE['custom'], hw_info=dict(self.CUSTOM_PROFILE['custom']['hw_info'], fw_ver='0x90'))):
+            with self.subTest(definition=definition), tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'profiles.json')
+                with open(path, 'w') as f:
+                    json.dump(dict(bad=definition), f)
+                with self.assertRaises(ValueError):
+                    registry.load(path)
+        self.assertNotIn('bad', registry)
+
+    def test_load_all_or_nothing(self):
+        '''No profile is registered if any profile in the file is invalid'''
+        registry = protocol.ProfileRegistry()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'profiles.json')
+            with open(path, 'w') as f:
+                json.dump(dict(self.CUSTOM_PROFILE, bad=dict(self.CUSTOM_PROFILE['custom'], layout='maimai')), f)
+            with self.assertRaises(ValueError):
+                registry.load(path)
+        self.assertNotIn('custom', registry)
+
+    def test_load_existing(self):
+        '''Loading cannot redefine registered profiles'''
+        registry = protocol.ProfileRegistry()
+        registry.register('diva', protocol.PROFILES['diva'].hw_info, 'diva')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'profiles.json')
+            with open(path, 'w') as f:
+                json.dump(dict(diva=self.CUSTOM_PROFILE['custom']), f)
+            with self.assertRaisesRegex(ValueError, 'already registered'):
+                registry.load(path)
+        self.assertEqual(registry['diva'].layout, 'diva')
+
+    def test_unknown_mode(self):
+        '''Unknown modes are rejected'''
+        with self.assertRaises(ValueError):
+            protocol.SliderDevice('maimai')
+
+class TestTracing(unittest.TestCase):
+    def test_trace_rx_tx(self):
+        '''Received and sent frames are traced'''
+        tracer = tracering.TraceRing()
+        harness = DeviceHarness(tracer=tracer)
+        harness.feed((encode_frame(protocol.SliderCommand.reset), encode_frame(protocol.SliderCommand.reset, corrupt=True)))
+        events = [(event, data) for _, event, data in tracer.events()]
+        self.assertEqual(events, [
+            ('connection_made', None),
+            ('rx', b'\x10\x00\xf1'),
+            ('tx', encode_frame(protocol.SliderCommand.reset)),
+            ('rx', b'\x10\x00\xab'),
+            ('bad_checksum', None),
+            ('tx', encode_frame(protocol.SliderCommand.exception, b'\xff\x01')),
+        ])
+
+    def test_trace_disabled(self):
+        '''Nothing is recorded when the tracer is disabled'''
+        tracer = tracering.TraceRing()
+        tracer.enabled = False
+        harness = DeviceHarness(tracer=tracer)
+        harness.feed((encode_frame(protocol.SliderCommand.reset),))
+        self.assertEqual(len(tracer), 0)
+
+class TestReceiveStress(unittest.TestCase):
+    CHUNK_SIZE = 4096
+
+    def _stream(self, size):
+        frame = encode_frame(protocol.SliderCommand.led_report, bytes((63,)) + bytes(range(0xa0, 0x100)) * 1)
+        count = size // len(frame)
+        return frame * count, count
+
+    def _run(self, stream):
+        harness = DeviceHarness()
+        start = time.perf_counter()
+        harness.feed(stream[i:i+self.CHUNK_SIZE] for i in range(0, len(stream), self.CHUNK_SIZE))
+        return time.perf_counter() - start, harness
+
+    def test_throughput_linear(self):
+        '''Receive time grows linearly with stream size'''
+        small, small_count = self._stream(1 << 20)
+        large, large_count = self._stream(4 << 20)
+        small_time, harness = self._run(small)
+        self.assertEqual(len(harness.leds), small_count)
+        large_time, harness = self._run(large)
+        self.assertEqual(len(harness.leds), large_count)
+        # 4x the data should not take much more than 4x the time
+        self.assertLess(large_time / small_time, 4 * 2)
+
+    def test_memory_bounded(self):
+        '''Memory usage does not grow with stream size'''
+        stream, _count = self._stream(4 << 20)
+        harness = DeviceHarness()
+        harness.device.on('led', lambda brightness, led_brg: None)
+        tracemalloc.start()
+        try:
+            harness.feed(stream[i:i+self.CHUNK_SIZE] for i in range(0, len(stream), self.CHUNK_SIZE))
+            _current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 256 << 10)
+
+class TestSoak(unittest.TestCase):
+    def test_allocation_budget(self):
+        '''Steady state allocations per tick stay within budget and nothing leaks, with and without tracing'''
+        for traced in (True, False):
+            with self.subTest(traced=traced):
+                result = soakbench.soak(duration=2.0, tick_rate=1000.0, led_rate=60.0, traced=traced)
+                self.assertEqual(result['ticks'], 2000)
+                self.assertLessEqual(result['alloc_bytes_per_tick'], soakbench.ALLOC_BUDGET)
+                self.assertLessEqual(result['retained_bytes_per_tick'], soakbench.RETAINED_BUDGET)
+
+class TestSliderHost(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        loop = asyncio.get_running_loop()
+        self.clock = FakeClock()
+        accepted = loop.create_future()
+        def host_factory():
+            host = protocol.SliderHost(timeout=0.5, clock=self.clock)
+            host.on('connection_made', lambda: accepted.set_result(host))
+            return host
+        server = await loop.create_server(host_factory, '127.0.0.1', 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        self.leds = []
+        self.reports_enabled = []
+        self.device = protocol.SliderDevice('diva')
+        self.device.on('led', lambda brightness, led_brg: self.leds.append((brightness, bytes(led_brg))))
+        self.device.on('report_state_change', lambda enabled: self.reports_enabled.append(enabled))
+        self.device_transport, _device = await loop.create_connection(lambda: self.device, '127.0.0.1', server.sockets[0].getsockname()[1])
+        self.addCleanup(self.device_transport.close)
+        self.host = await accepted
+
+    async def test_requests(self):
+        '''Requests complete with the device's replies'''
+        self.assertEqual(await self.host.get_hw_info(), protocol.PROFILES['diva'].hw_info)
+        await self.host.reset()
+        await self.host.enable_reports()
+        await self.host.disable_reports()
+        self.assertEqual(self.reports_enabled, [True, False])
+
+    async def test_concurrent_requests(self):
+        '''Concurrent requests for the same command each get a reply'''
+        results = await asyncio.gather(*(self.host.get_hw_info() for _ in range(10)))
+        self.assertEqual(set(results), {protocol.PROFILES['diva'].hw_info})
+
+    async def test_send_led(self):
+        '''LED reports reach the device'''
+        await self.host.send_led(63, bytes(range(96)))
+        await self.host.reset()
+        self.assertEqual(self.leds, [(63, bytes(range(96)))])
+
+    async def test_reports(self):
+        '''Input reports are timestamped and iteration ends when the connection is lost'''
+        await self.host.enable_reports()
+        for i in range(3):
+            self.clock.now = float(i)
+            self.device.send_input_report(bytes((i,)) * 32)
+            # Let the report arrive before advancing the clock
+            await self.host.reset()
+        self.device_transport.close()
+        reports = [report async for report in self.host.reports()]
+        self.assertEqual(reports, [protocol.InputReport(float(i), bytes((i,)) * 32) for i in range(3)])
+
+    async def test_reports_overflow(self):
+        '''Oldest reports are dropped when the consumer falls behind'''
+        host = protocol.SliderHost(max_queued_reports=2)
+        host.connection_made(FakeTransport())
+        for i in range(3):
+            host.data_received(encode_frame(protocol.SliderCommand.input_report, bytes((i,)) * 32))
+        host.connection_lost(None)
+        reports = [report.data[0] async for report in host.reports()]
+        self.assertEqual(reports, [1, 2])
+        self.assertEqual(host.reports_dropped, 1)
+
+    async def test_reports_full_queue_close(self):
+        '''Closing the connection does not evict queued reports'''
+        host = protocol.SliderHost(max_queued_reports=2)
+        host.connection_made(FakeTransport())
+        for i in range(2):
+            host.data_received(encode_frame(protocol.SliderCommand.input_report, bytes((i,)) * 32))
+        host.connection_lost(None)
+        reports = [report.data[0] async for report in host.reports()]
+        self.assertEqual(reports, [0, 1])
+        self.assertEqual(host.reports_dropped, 0)
+
+    async def test_timeout(self):
+        '''Requests time out if the device does not reply'''
+        host = protocol.SliderHost(timeout=0.01)
+        host.connection_made(FakeTransport())
+        with self.assertRaises(asyncio.TimeoutError):
+            await host.reset()
+        self.assertEqual(host._pending[protocol.SliderCommand.reset], collections.deque())
+
+    async def test_connection_lost(self):
+        '''Pending and later requests fail once the connection is lost'''
+        host = protocol.SliderHost()
+        host.connection_made(FakeTransport())
+        request = asyncio.ensure_future(host.get_hw_info())
+        await asyncio.sleep(0)
+        host.connection_lost(None)
+        with self.assertRaises(ConnectionError):
+            await request
+        with self.assertRaises(ConnectionError):
+            await host.send_led(63, bytes(96))
+
+class TestLoadgen(unittest.TestCase):
+    def test_many_devices(self):
+        '''Drive many emulated devices concurrently'''
+        result = asyncio.run(loadgen.loadgen(devices=50, duration=0.5, tick_rate=50.0, led_rate=20.0))
+        self.assertEqual(result['hosts'], 50)
+        self.assertEqual(result['failed'], 0)
+        self.assertGreater(result['input_reports'], 0)
+        self.assertEqual(result['led_reports_delivered'], result['led_reports'])
+
+if __name__ == '__main__':
+    unittest.main()
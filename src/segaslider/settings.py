@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import typing as T
+
+import json
+import math
+import os
+import urllib.parse
+
+SECTION = 'segaslider'
+SETTINGS_PANEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'segaslider.settings.json')
+
+DEFAULTS = dict(
+    port='serial:/dev/ttyUSB0',
+    mode='diva',
+    layout='auto',
+    hwinfo='auto',
+    diffuser='auto',
+    x_overlap_mm=6.0,
+    y_overlap_mm=6.0,
+    gamma=0.5,
+    diffuser_width=16.0,
+    profiler=0,
+    profiler_rate=100.0,
+)
+
+SUPPORTED_SCHEMES = ('tcp', 'serial', 'rfcomm')
+
+
+def _check_port(value: str) -> None:
+    if urllib.parse.urlparse(value).scheme not in SUPPORTED_SCHEMES:
+        raise ValueError(f'Unsupported URI scheme in {value!r}')
+
+
+def _check_non_negative(value: float) -> None:
+    if value < 0:
+        raise ValueError('Value must not be negative')
+
+
+def _check_positive(value: float) -> None:
+    if value <= 0:
+        raise ValueError('Value must be positive')
+
+
+# Extra constraints on top of what the settings panel type implies
+_CONSTRAINTS = dict(
+    port=_check_port,
+    x_overlap_mm=_check_non_negative,
+    y_overlap_mm=_check_non_negative,
+    gamma=_check_positive,
+    profiler_rate=_check_positive,
+)
+
+
+def load_panel(path: str = SETTINGS_PANEL_PATH, modes: T.Optional[T.Sequence[str]] = None) -> T.List[T.Dict[str, T.Any]]:
+    '''
+    Load the settings panel definition. If modes is set, it replaces the
+    options of the mode and hwinfo settings.
+    '''
+    with open(path, 'r') as f:
+        panel = json.load(f)
+    if modes is not None:
+        for item in panel:
+            if item.get('section') != SECTION:
+                continue
+            if item.get('key') == 'mode':
+                item['options'] = list(modes)
+            elif item.get('key') == 'hwinfo':
+                item['options'] = ['auto'] + list(modes)
+    return panel
+
+
+class SettingsValidator(object):
+    '''
+    Parses and validates raw config values using the types declared in a Kivy
+    settings panel definition.
+    '''
+    def __init__(self, panel: T.Sequence[T.Mapping[str, T.Any]], section: str = SECTION) -> None:
+        self._parsers = {}
+        for item in panel:
+            if item.get('section') != section or 'key' not in item:
+                continue
+            self._parsers[item['key']] = self._make_parser(item)
+
+    @classmethod
+    def from_file(cls, path: str = SETTINGS_PANEL_PATH, section: str = SECTION) -> 'SettingsValidator':
+        return cls(load_panel(path), section)
+
+    @staticmethod
+    def _make_parser(item: T.Mapping[str, T.Any]) -> T.Callable[[T.Any], T.Any]:
+        type_ = item['type']
+        key = item['key']
+        constraint = _CONSTRAINTS.get(key)
+        if type_ == 'options':
+            options = tuple(item['options'])
+            def parse(raw):
+                value = str(raw)
+                if value not in options:
+                    raise ValueError(f'{key} must be one of {", ".join(options)} (got {value!r})')
+                return value
+        elif type_ == 'numeric':
+            def parse(raw):
+                try:
+                    value = float(raw)
+                except (TypeError, ValueError):
+                    raise ValueError(f'{key} must be a number (got {raw!r})') from None
+                # nan and inf parse as floats and pass every comparison
+                if not math.isfinite(value):
+                    raise ValueError(f'{key} must be a finite number (got {raw!r})')
+                if constraint is not None:
+                    constraint(value)
+                return value
+        elif type_ == 'bool':
+            def parse(raw):
+                value = str(raw)
+                if value not in ('0', '1', 'True', 'False'):
+                    raise ValueError(f'{key} must be a boolean (got {raw!r})')
+                return value in ('1', 'True')
+        elif type_ == 'string':
+            def parse(raw):
+                value = str(raw)
+                if constraint is not None:
+                    constraint(value)
+                return value
+        else:
+            raise ValueError(f'Unsupported setting type {type_} for {key}')
+        return parse
+
+    def keys(self) -> T.KeysView[str]:
+        return self._parsers.keys()
+
+    def parse(self, key: str, raw: T.Any) -> T.Any:
+        '''Parse and validate a raw value. Raises ValueError if the value is not acceptable.'''
+        if key not in self._parsers:
+            raise KeyError(key)
+        return self._parsers[key](raw)
+
+
+class SliderSettings(object):
+    '''
+    Immutable snapshot of the parsed slider settings. Use replace() to derive a
+    new snapshot when a setting changes.
+    '''
+    __slots__ = tuple(DEFAULTS.keys())
+
+    def __init__(self, **kwargs: T.Any) -> None:
+        for key in self.__slots__:
+            object.__setattr__(self, key, kwargs[key])
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, key):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __repr__(self):
+        fields = ', '.join(f'{key}={getattr(self, key)!r}' for key in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+    def __eq__(self, other):
+        if not isinstance(other, SliderSettings):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key) for key in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, key) for key in self.__slots__))
+
+    @classmethod
+    def from_config(cls, config, validator: SettingsValidator, section: str = SECTION,
+                    on_error: T.Optional[T.Callable[[str, ValueError], None]] = None) -> 'SliderSettings':
+        '''
+        Build a snapshot from a ConfigParser. Invalid values fall back to their
+        defaults and are reported through on_error.
+        '''
+        values = {}
+        for key in cls.__slots__:
+            try:
+                values[key] = validator.parse(key, config.get(section, key))
+            except ValueError as e:
+                if on_error is not None:
+                    on_error(key, e)
+                values[key] = validator.parse(key, DEFAULTS[key])
+        return cls(**values)
+
+    def replace(self, validator: SettingsValidator, key: str, raw: T.Any) -> 'SliderSettings':
+        '''Return a new snapshot with one setting changed. Raises ValueError on invalid value.'''
+        values = {k: getattr(self, k) for k in self.__slots__}
+        values[key] = validator.parse(key, raw)
+        return type(self)(**values)
+
+    def raw(self, key: str) -> str:
+        '''Value of a setting in the form stored in the config file.'''
+        value = getattr(self, key)
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        return str(value)
+
+    def effective_layout(self, profile_layout: str) -> str:
+        '''Layout to use given the default layout of the selected profile.'''
+        return profile_layout if self.layout == 'auto' else self.layout
+
+    @property
+    def effective_hwinfo(self) -> str:
+        return self.mode if self.hwinfo == 'auto' else self.hwinfo
+
+    def diffuser_enabled(self, slider_layout: str) -> bool:
+        return (self.diffuser == 'auto' and slider_layout == 'diva') or self.diffuser == 'force_on'
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import configparser
+import unittest
+from settings import DEFAULTS, SECTION, SettingsValidator, SliderSettings, load_panel
+
+def _make_config(**overrides):
+    config = configparser.ConfigParser()
+    config.add_section(SECTION)
+    for key, value in dict(DEFAULTS, **overrides).items():
+        config.set(SECTION, key, str(value))
+    return config
+
+class TestSettings(unittest.TestCase):
+    def setUp(self):
+        self.validator = SettingsValidator.from_file()
+
+    def test_panel_covers_defaults(self):
+        '''Every default has a validator from the settings panel'''
+        self.assertEqual(set(self.validator.keys()), set(DEFAULTS.keys()))
+
+    def test_from_config(self):
+        '''Snapshot parses typed values'''
+        snapshot = SliderSettings.from_config(_make_config(gamma='1.5', mode='chu'), self.validator)
+        self.assertEqual(snapshot.gamma, 1.5)
+        self.assertEqual(snapshot.mode, 'chu')
+        self.assertEqual(snapshot.effective_layout('chu'), 'chu')
+        self.assertEqual(snapshot.effective_hwinfo, 'chu')
+
+    def test_from_config_bad_value(self):
+        '''Invalid values fall back to defaults'''
+        errors = []
+        snapshot = SliderSettings.from_config(_make_config(gamma='bright'), self.validator, on_error=lambda k, e: errors.append(k))
+        self.assertEqual(snapshot.gamma, DEFAULTS['gamma'])
+        self.assertEqual(errors, ['gamma'])
+
+    def test_immutable(self):
+        '''Snapshot is immutable'''
+        snapshot = SliderSettings.from_config(_make_config(), self.validator)
+        with self.assertRaises(AttributeError):
+            snapshot.gamma = 1.0
+        with self.assertRaises(AttributeError):
+            snapshot.foo = 1.0
+
+    def test_replace(self):
+        '''Replace validates and derives a new snapshot'''
+        snapshot = SliderSettings.from_config(_make_config(), self.validator)
+        new_snapshot = snapshot.replace(self.validator, 'layout', 'chu')
+        self.assertEqual(snapshot.layout, 'auto')
+        self.assertEqual(new_snapshot.layout, 'chu')
+        self.assertEqual(new_snapshot.effective_layout('diva'), 'chu')
+
+    def test_replace_bad_value(self):
+        '''Replace rejects invalid values'''
+        snapshot = SliderSettings.from_config(_make_config(), self.validator)
+        for key, value in (('mode', 'maimai'), ('gamma', '0'), ('x_overlap_mm', '-1'), ('diffuser_width', 'wide'), ('port', 'http://localhost'),
+                           ('gamma', 'nan'), ('x_overlap_mm', 'nan'), ('profiler_rate', 'inf'), ('gamma', '-inf')):
+            with self.subTest(key=key, value=value), self.assertRaises(ValueError):
+                snapshot.replace(self.validator, key, value)
+
+    def test_extra_modes(self):
+        '''Mode options can be extended'''
+        validator = SettingsValidator(load_panel(modes=('diva', 'chu', 'custom')))
+        snapshot = SliderSettings.from_config(_make_config(mode='custom', hwinfo='custom'), validator)
+        self.assertEqual(snapshot.mode, 'custom')
+        self.assertEqual(snapshot.effective_hwinfo, 'custom')
+        with self.assertRaises(ValueError):
+            self.validator.parse('mode', 'custom')
+
+    def test_bool(self):
+        '''Bool settings'''
+        snapshot = SliderSettings.from_config(_make_config(), self.validator)
+        self.assertIs(snapshot.profiler, False)
+        self.assertEqual(snapshot.raw('profiler'), '0')
+        snapshot = snapshot.replace(self.validator, 'profiler', '1')
+        self.assertIs(snapshot.profiler, True)
+        self.assertEqual(snapshot.raw('profiler'), '1')
+        with self.assertRaises(ValueError):
+            snapshot.replace(self.validator, 'profiler', 'maybe')
+
+    def test_diffuser_enabled(self):
+        '''Diffuser override'''
+        snapshot = SliderSettings.from_config(_make_config(), self.validator)
+        self.assertTrue(snapshot.diffuser_enabled('diva'))
+        self.assertFalse(snapshot.diffuser_enabled('chu'))
+        snapshot = snapshot.replace(self.validator, 'diffuser', 'force_on')
+        self.assertTrue(snapshot.diffuser_enabled('chu'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+'''
+Long-run memory and GC soak benchmark for the protocol pipelines.
+
+Simulates a session of the given duration where the device sends input
+reports at the tick rate and the host sends LED reports periodically, then
+reports memory usage, per-frame allocations and the longest GC pause. LED
+reports and touch input go through the app's processing (pipelines.py)
+with headless widgets, and frames are traced like in the app unless
+--no-trace is given.
+
+The allocation budget is a regression guard for what is still allocated
+per frame, not zero:
+
+- Every sent frame is a new bytearray. Transports may hold on to the
+  written object until it is sent (pyserial-asyncio queues it as is), so a
+  reused buffer could be overwritten before it goes out.
+- Decoding a received chunk builds the list of segments and their
+  unescaped bytes.
+- Received packets are handed to handlers as memoryview slices of the
+  receive buffer.
+- Every repainted LED segment gets a new value list, as Kivy properties
+  need a new value to notice the change.
+
+Usage: python -m segaslider.soakbench [--duration SECONDS] [--tick-rate HZ] [--no-trace] [--profile PREFIX]
+'''
+
+import typing as T
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+from . import pipelines
+from . import protocol
+from .protocol import encode_frame
+from .protocolbench import add_profile_arguments, make_device, profiled
+from .helper import tracering
+
+# Default budgets, in bytes per simulated tick
+ALLOC_BUDGET = 256
+RETAINED_BUDGET = 1
+
+
+def rss_bytes() -> T.Optional[int]:
+    '''Current resident set size if available, otherwise peak resident set size.'''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class GCPauseMonitor(object):
+    def __init__(self):
+        self.collections = 0
+        self.longest = 0.0
+        self.total = 0.0
+        self._start = None
+
+    def _callback(self, phase, info):
+        if phase == 'start':
+            self._start = time.perf_counter()
+        elif self._start is not None:
+            pause = time.perf_counter() - self._start
+            self._start = None
+            self.collections += 1
+            self.total += pause
+            self.longest = max(self.longest, pause)
+
+    def __enter__(self):
+        gc.callbacks.append(self._callback)
+        return self
+
+    def __exit__(self, *exc):
+        gc.callbacks.remove(self._callback)
+
+
+class HeadlessLED(object):
+    '''Stands in for the app's LED widget.'''
+    def __init__(self, led_index: int) -> None:
+        self.led_index = led_index
+        self.led_value = [0, 0, 0]
+
+
+class HeadlessElectrode(object):
+    '''Stands in for the app's electrode widget.'''
+    def __init__(self, electrode_index: int) -> None:
+        self.electrode_index = electrode_index
+        self.value = 0
+
+
+class Session(object):
+    '''
+    Simulated host/device session driven one tick at a time. LED reports and
+    touch input go through the same processing as in the app, with headless
+    widgets.
+    '''
+    def __init__(self, led_every: int, mode: str = 'diva', gamma: float = 0.5,
+                 tracer: T.Optional[tracering.TraceRing] = None) -> None:
+        self.device, self.transport = make_device(mode, tracer)
+        self.led_every = led_every
+        self.ticks = 0
+        self.led_reports = 0
+        self.painter = pipelines.LEDPainter(gamma)
+        self.leds = [HeadlessLED(i) for i in range(32)]
+        self.electrodes = [HeadlessElectrode(i) for i in range(32)]
+        self._input_report = bytearray(32)
+        # A handful of distinct LED reports, like a game cycling animations
+        self._led_frames = tuple(
+            encode_frame(protocol.SliderCommand.led_report, bytes((63,)) + bytes(((i * 7 + j) & 0xff for j in range(96))))
+            for i in range(8)
+        )
+        self.device.on('led', self._on_led)
+
+    def _on_led(self, brightness, led_brg):
+        self.led_reports += 1
+        self.painter.paint(brightness, led_brg, self.leds)
+
+    def tick(self) -> None:
+        ticks = self.ticks
+        # Touch state changes every few ticks
+        self.electrodes[ticks & 0x1f].value = 0xfe if ticks & 0x20 else 0x00
+        pipelines.fill_input_report(self._input_report, self.electrodes)
+        self.device.send_input_report(self._input_report)
+        if ticks % self.led_every == 0:
+            self.device.data_received(self._led_frames[(ticks // self.led_every) & 0x7])
+        self.ticks = ticks + 1
+
+
+def soak(duration: float, tick_rate: float, led_rate: float, warmup: int = 1000, traced: bool = True) -> T.Dict[str, float]:
+    ticks = int(duration * tick_rate)
+    # Same tracer as the app
+    tracer = tracering.TraceRing(slot_size=protocol.MAX_PACKET_LEN) if traced else None
+    session = Session(led_every=max(int(tick_rate / led_rate), 1), tracer=tracer)
+    rss_before = rss_bytes()
+    tracemalloc.start()
+    try:
+        # Warm up with tracing on, so that state replaced during the run (e.g. widget
+        # values) was already allocated under tracing and doesn't show up as retained
+        for _ in range(warmup):
+            session.tick()
+        # Fill the trace ring too, until then every recorded event adds a timestamp
+        while tracer is not None and len(tracer) < tracer.capacity:
+            session.tick()
+        with GCPauseMonitor() as gc_monitor:
+            start = time.perf_counter()
+            baseline, _peak = tracemalloc.get_traced_memory()
+            alloc_total = 0
+            alloc_max = 0
+            for _ in range(ticks):
+                before, _peak = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                session.tick()
+                _current, peak = tracemalloc.get_traced_memory()
+                alloc = peak - before
+                alloc_total += alloc
+                alloc_max = max(alloc_max, alloc)
+            elapsed = time.perf_counter() - start
+            retained, _peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    rss_after = rss_bytes()
+
+    return dict(
+        ticks=ticks,
+        led_reports=session.led_reports,
+        elapsed=elapsed,
+        alloc_bytes_per_tick=alloc_total / max(ticks, 1),
+        alloc_bytes_max=alloc_max,
+        retained_bytes_per_tick=(retained - baseline) / max(ticks, 1),
+        gc_collections=gc_monitor.collections,
+        gc_pause_longest_ms=gc_monitor.longest * 1000,
+        gc_pause_total_ms=gc_monitor.total * 1000,
+        rss_before=rss_before if rss_before is not None else -1,
+        rss_after=rss_after if rss_after is not None else -1,
+    )
+
+
+def main(argv: T.Optional[T.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Slider protocol memory/GC soak benchmark.')
+    parser.add_argument('--duration', type=float, default=60.0, help='Simulated session length in seconds (default: 60)')
+    parser.add_argument('--tick-rate', type=float, default=1000.0, help='Input reports per simulated second (default: 1000)')
+    parser.add_argument('--led-rate', type=float, default=60.0, help='LED reports per simulated second (default: 60)')
+    parser.add_argument('--alloc-budget', type=float, default=ALLOC_BUDGET, help=f'Maximum average bytes allocated per tick (default: {ALLOC_BUDGET})')
+    parser.add_argument('--retained-budget', type=float, default=RETAINED_BUDGET, help=f'Maximum bytes retained per tick (default: {RETAINED_BUDGET})')
+    parser.add_argument('--no-trace', action='store_true', help='Do not trace frames (the app always does)')
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # The profiler's own allocations are counted too, so budgets are only meaningful without it
+    with profiled(args):
+        result = soak(args.duration, args.tick_rate, args.led_rate, traced=not args.no_trace)
+    for key, value in result.items():
+        print(f'{key}: {value:.3f}' if isinstance(value, float) else f'{key}: {value}')
+
+    ok = True
+    if result['alloc_bytes_per_tick'] > args.alloc_budget:
+        print(f'FAIL: {result["alloc_bytes_per_tick"]:.1f} bytes allocated per tick exceeds budget of {args.alloc_budget:.1f}')
+        ok = False
+    if result['retained_bytes_per_tick'] > args.retained_budget:
+        print(f'FAIL: {result["retained_bytes_per_tick"]:.3f} bytes retained per tick exceeds budget of {args.retained_budget:.3f}')
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())